@@ -0,0 +1,145 @@
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+
+import os
+import time
+import pickle
+import sqlite3
+import threading
+
+
+class SQLiteCache(BaseCache):
+    """
+    Cache backend storing the entries in a single SQLite file, shared by all
+    worker processes on the host and surviving their restarts.
+
+    LOCATION is the path to the database file. The total size of stored values is
+    bounded by OPTIONS['MAX_SIZE'] bytes, with least recently used entries evicted first.
+    """
+
+    # How often, in number of writes per process, to check the total size
+    cull_every = 64
+
+    # Do not update the access time on every hit more often than that, in seconds
+    touch_interval = 60
+
+    def __init__(self, location, params):
+        super().__init__(params)
+
+        options = params.get('OPTIONS', {})
+        self._path = location
+        self._max_size = int(options.get('MAX_SIZE', 1024**3))
+        self._local = threading.local()
+        self._writes = 0
+
+        dirname = os.path.dirname(self._path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, size INTEGER, expires REAL, accessed REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+
+        return conn
+
+    def _get(self, key, now):
+        row = self._connection().execute("SELECT value, expires, accessed FROM cache WHERE key = ?", (key,)).fetchone()
+
+        if row is None:
+            return None
+
+        value,expires,accessed = row
+
+        if expires is not None and expires <= now:
+            self._connection().execute("DELETE FROM cache WHERE key = ? AND expires <= ?", (key, now))
+            return None
+
+        if accessed < now - self.touch_interval:
+            self._connection().execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+
+        return value
+
+    def _set(self, key, value, timeout, mode='REPLACE'):
+        now = time.time()
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+        cursor = self._connection().execute(
+            "INSERT OR %s INTO cache (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)" % mode,
+            (key, value, len(value), self.get_backend_timeout(timeout), now)
+        )
+
+        self._writes += 1
+        if self._writes % self.cull_every == 0:
+            self._cull(now)
+
+        return cursor.rowcount > 0
+
+    def _cull(self, now):
+        conn = self._connection()
+
+        conn.execute("DELETE FROM cache WHERE expires IS NOT NULL AND expires <= ?", (now,))
+
+        total = conn.execute("SELECT coalesce(sum(size), 0) FROM cache").fetchone()[0]
+
+        if total > self._max_size:
+            # Keep the most recently used entries fitting into 90% of the limit
+            conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM (SELECT key, sum(size) OVER (ORDER BY accessed DESC) AS total FROM cache) WHERE total > ?)",
+                (0.9*self._max_size,)
+            )
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        value = self._get(key, time.time())
+
+        if value is None:
+            return default
+
+        return pickle.loads(value)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        self._set(key, value, timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+
+        # Drop the expired entry so that it does not block the insertion
+        self._connection().execute("DELETE FROM cache WHERE key = ? AND expires <= ?", (key, time.time()))
+
+        return self._set(key, value, timeout, mode='IGNORE')
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        cursor = self._connection().execute(
+            "UPDATE cache SET expires = ? WHERE key = ? AND (expires IS NULL OR expires > ?)",
+            (self.get_backend_timeout(timeout), key, time.time())
+        )
+
+        return cursor.rowcount > 0
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        cursor = self._connection().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+        return cursor.rowcount > 0
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+
+        return self._get(key, time.time()) is not None
+
+    def clear(self):
+        self._connection().execute("DELETE FROM cache")
+
+    def close(self, **kwargs):
+        # Connections are kept open for the lifetime of the thread
+        pass
@@ -0,0 +1,478 @@
+from django.conf import settings
+
+import os, posixpath
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from .models import Calibrations
+
+# FRAM modules
+from fram import calibrate
+
+
+# Calibration types that do not depend on the exposure of the frame
+EXPOSURE_INDEPENDENT_TYPES = ['bias', 'dcurrent', 'masterflat']
+
+# Calibration types that depend on the filter of the frame
+FILTER_DEPENDENT_TYPES = ['masterflat']
+
+# Image types that are calibration products themselves, and are never calibrated
+MASTER_TYPES = ['masterdark', 'masterflat', 'bias', 'dcurrent']
+
+
+class LookupCache:
+    """
+    Bounded LRU mapping with per-entry expiration, safe to share between threads.
+    """
+
+    def __init__(self, size=1024, timeout=3600):
+        self.size = size
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+
+            value,expires = entry
+            if self.timeout and expires < time.monotonic():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + (self.timeout or 0))
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+_lookup_cache = LookupCache(
+    size=settings.CALIBRATION_LOOKUP_CACHE_SIZE,
+    timeout=settings.CALIBRATION_LOOKUP_CACHE_TIMEOUT,
+)
+
+_MISSING = object()
+
+
+def calibration_key(image, type='masterdark'):
+    """
+    Key identifying the set of calibration frames suitable for a given image
+    """
+    return (
+        type,
+        image.site, image.ccd, image.serial,
+        image.exposure if type not in EXPOSURE_INDEPENDENT_TYPES else None,
+        image.cropped_width, image.cropped_height, image.binning,
+        image.filter if type in FILTER_DEPENDENT_TYPES else None,
+        image.night,
+    )
+
+
+def query_calibration_image(image, type='masterdark'):
+    calibs = Calibrations.objects.all()
+
+    calibs = calibs.filter(type=type)
+
+    calibs = calibs.filter(site=image.site)
+    calibs = calibs.filter(ccd=image.ccd)
+    calibs = calibs.filter(serial=image.serial)
+
+    if type not in EXPOSURE_INDEPENDENT_TYPES:
+        calibs = calibs.filter(exposure=image.exposure)
+
+    calibs = calibs.filter(cropped_width=image.cropped_width)
+    calibs = calibs.filter(cropped_height=image.cropped_height)
+    calibs = calibs.filter(binning=image.binning)
+
+    if type in FILTER_DEPENDENT_TYPES:
+        calibs = calibs.filter(filter=image.filter)
+
+    calib = calibs.filter(night__lte=image.night).order_by('-night').first()
+    if calib is None:
+        # No frames earlier than the date, let's look for a later one!
+        calib = calibs.filter(night__gte=image.night).order_by('night').first()
+
+    return calib
+
+
+def find_calibration_image(image, type='masterdark'):
+    """
+    Find the calibration frame of a given type best suited for the image.
+    Results, including missing ones, are cached per night and instrument configuration.
+    """
+    key = calibration_key(image, type)
+
+    calib = _lookup_cache.get(key, _MISSING)
+    if calib is _MISSING:
+        calib = query_calibration_image(image, type)
+        _lookup_cache.set(key, calib)
+
+    return calib
+
+
+def invalidate_calibrations():
+    """
+    Drop all cached calibration lookups, e.g. after new calibration frames are ingested
+    """
+    _lookup_cache.clear()
+
+
+class ArrayCache:
+    """
+    LRU cache of read-only NumPy arrays bounded by their total size in bytes.
+    """
+
+    def __init__(self, max_bytes=1024**3):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        value.flags.writeable = False
+
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._data.pop(key).nbytes
+
+            if value.nbytes > self.max_bytes:
+                # Too large to be cached at all
+                return value
+
+            self._data[key] = value
+            self.nbytes += value.nbytes
+
+            while self.nbytes > self.max_bytes:
+                _,old = self._data.popitem(last=False)
+                self.nbytes -= old.nbytes
+
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+
+_data_cache = ArrayCache(
+    max_bytes=settings.CALIBRATION_DATA_CACHE_SIZE*1024**2,
+)
+
+
+def calibration_filename(calib):
+    return posixpath.join(settings.BASE_DIR, calib.filename)
+
+
+def calibration_stamp(calib):
+    """
+    Identity of the calibration frame contents - its id and file modification time
+    """
+    return (calib.id, os.path.getmtime(calibration_filename(calib)))
+
+
+def get_calibration_data(calib):
+    """
+    Decoded pixel data of the calibration frame, as a shared read-only float32 array
+    """
+    key = ('data',) + calibration_stamp(calib)
+
+    data = _data_cache.get(key)
+    if data is None:
+        data = fits.getdata(calibration_filename(calib), -1).astype(np.float32)
+        data = _data_cache.set(key, data)
+
+    return data
+
+
+def get_flat_correction(cflat):
+    """
+    Multiplicative flat-field correction, i.e. median(flat)/flat
+    """
+    key = ('flatcorr',) + calibration_stamp(cflat)
+
+    corr = _data_cache.get(key)
+    if corr is None:
+        flat = get_calibration_data(cflat)
+        corr = np.median(flat) / flat
+        corr = _data_cache.set(key, corr.astype(np.float32, copy=False))
+
+    return corr
+
+
+def get_bias_dark(cbias, cdc, exposure):
+    """
+    Synthetic dark frame for a given exposure, i.e. bias + exposure*dcurrent
+    """
+    key = ('biasdark', exposure) + calibration_stamp(cbias) + calibration_stamp(cdc)
+
+    dark = _data_cache.get(key)
+    if dark is None:
+        dark = get_calibration_data(cdc) * np.float32(exposure)
+        dark += get_calibration_data(cbias)
+        dark = _data_cache.set(key, dark)
+
+    return dark
+
+
+def get_cropped_geometry(header):
+    """
+    Offset and shape of the usable, overscan-cropped, area of the raw frame, and the header
+    corresponding to it. Derived from a dry run of crop_overscans over a zero-strided placeholder,
+    and the shift it applies to the WCS reference pixel. Returns None if it cannot be determined.
+    """
+    if 'CRPIX1' not in header or 'CRPIX2' not in header:
+        return None
+
+    shape = (header['NAXIS2'], header['NAXIS1'])
+
+    # Placeholder of a full frame shape taking no memory
+    placeholder = np.lib.stride_tricks.as_strided(np.zeros(1, dtype=np.float32), shape=shape, strides=(0, 0), writeable=False)
+
+    try:
+        cropped,cheader = calibrate.crop_overscans(placeholder, header, subtract=False)
+    except:
+        return None
+
+    offset = (int(round(header['CRPIX2'] - cheader['CRPIX2'])), int(round(header['CRPIX1'] - cheader['CRPIX1'])))
+
+    return offset, shape, cropped.shape, cheader
+
+
+def processed_path(pipeline):
+    """
+    Location of the calibrated frame in the on-disk store of processed files
+    """
+    key = hashlib.sha1(repr(pipeline.identity()).encode()).hexdigest()
+
+    return os.path.join(settings.PROCESSED_PATH, key[:2], key + '.fits')
+
+
+def invalidate_calibration_data():
+    """
+    Drop all cached calibration arrays
+    """
+    _data_cache.clear()
+
+
+class CalibrationPipeline:
+    """
+    Calibration of a science frame - dark subtraction, linearization, overscan
+    cropping and flat-fielding - working on a single float32 buffer.
+
+    Calibration frames are resolved once on construction, and their data are
+    taken from the shared cache, so the same object may be re-used for several
+    frames sharing the configuration, e.g. in batch jobs.
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self.cdark = None
+        self.cbias = None
+        self.cdc = None
+        self.cflat = None
+
+        if image.type in MASTER_TYPES:
+            return
+
+        if image.type not in ['dark', 'zero']:
+            self.cdark = find_calibration_image(image, 'masterdark')
+
+            if self.cdark is None:
+                cbias,cdc = find_calibration_image(image, 'bias'), find_calibration_image(image, 'dcurrent')
+                if cbias is not None and cdc is not None:
+                    self.cbias,self.cdc = cbias,cdc
+
+        if image.type not in ['flat', 'dark', 'zero']:
+            self.cflat = find_calibration_image(image, 'masterflat')
+
+    @property
+    def enabled(self):
+        return self.image.type not in MASTER_TYPES
+
+    @property
+    def dark(self):
+        if self.cdark is not None:
+            return get_calibration_data(self.cdark)
+        elif self.cbias is not None:
+            return get_bias_dark(self.cbias, self.cdc, self.image.exposure)
+        else:
+            return None
+
+    @property
+    def flat(self):
+        if self.cflat is not None:
+            return get_flat_correction(self.cflat)
+        else:
+            return None
+
+    def identity(self):
+        """
+        Everything the calibrated frame depends upon - the frame itself and the calibration frames
+        """
+        filename = posixpath.join(settings.BASE_DIR, self.image.filename)
+        calibs = [calibration_stamp(_) if _ is not None else None for _ in (self.cdark, self.cbias, self.cdc, self.cflat)]
+
+        return (self.image.id, os.path.getmtime(filename), tuple(calibs))
+
+    def apply(self, data, header):
+        """
+        Calibrate the frame. Integer data are converted to float32 once, float32 data are modified in place.
+        """
+        if not self.enabled:
+            return data, header
+
+        data = np.asarray(data, dtype=np.float32)
+
+        dark = self.dark
+        if dark is not None:
+            data,header = calibrate.calibrate(data, header, dark=dark) # Subtract dark and linearize
+
+            flat = self.flat
+            if flat is not None:
+                np.multiply(data, flat, out=data, casting='unsafe')
+        else:
+            data,header = calibrate.crop_overscans(data, header)
+
+        return data, header
+
+    def process(self, filename=None):
+        """
+        Read the frame from disk and calibrate it
+        """
+        if filename is None:
+            filename = posixpath.join(settings.BASE_DIR, self.image.filename)
+
+        data = fits.getdata(filename, -1)
+        header = fits.getheader(filename, -1)
+
+        return self.apply(data, header)
+
+    def process_region(self, filename, x1, y1, width, height, header=None, geometry=None):
+        """
+        Read and calibrate only a rectangular region of the frame, given in the pixel coordinates
+        of the overscan-cropped frame. Pixels outside of the frame are set to NaN.
+
+        Overscan subtraction and linearization need the whole frame, so only dark subtraction
+        and flat-fielding are applied. Returns None if the region cannot be mapped to the raw frame.
+        """
+        if header is None:
+            header = fits.getheader(filename, -1)
+
+        if geometry is None:
+            geometry = get_cropped_geometry(header)
+            if geometry is None:
+                return None
+
+        offset,shape,cshape,cheader = geometry
+
+        src = [max(y1, 0), min(y1 + height, cshape[0]), max(x1, 0), min(x1 + width, cshape[1])]
+        dst = [src[0] - y1, src[1] - y1, src[2] - x1, src[3] - x1]
+
+        sub = np.empty((height, width), dtype=np.float32)
+        sub.fill(np.nan)
+
+        if src[0] < src[1] and src[2] < src[3]:
+            view = sub[dst[0]:dst[1], dst[2]:dst[3]]
+
+            def region(frame):
+                # Calibration frames may be either in raw or in cropped pixel grid
+                if frame.shape == tuple(cshape):
+                    dy,dx = 0,0
+                elif frame.shape == tuple(shape):
+                    dy,dx = offset
+                else:
+                    raise ValueError('Calibration frame shape %s does not match the image' % str(frame.shape))
+
+                return frame[src[0] + dy:src[1] + dy, src[2] + dx:src[3] + dx]
+
+            with fits.open(filename, memmap=False) as hdul:
+                # Section access reads just the requested rows from disk
+                view[...] = region(hdul[-1].section)
+
+            if self.enabled:
+                try:
+                    dark = self.dark
+                    if dark is not None:
+                        view -= region(dark)
+
+                        flat = self.flat
+                        if flat is not None:
+                            view *= region(flat)
+                except ValueError:
+                    return None
+
+        subheader = cheader.copy()
+
+        subheader['NAXIS1'] = width
+        subheader['NAXIS2'] = height
+
+        subheader['CRPIX1'] -= x1
+        subheader['CRPIX2'] -= y1
+
+        # Crop position inside the frame
+        subheader['CROP_X1'] = x1
+        subheader['CROP_X2'] = x1 + width
+        subheader['CROP_Y1'] = y1
+        subheader['CROP_Y2'] = y1 + height
+
+        return sub, subheader
+
+    def process_cutout(self, filename, ra, dec, sr):
+        """
+        Calibrated square cutout of radius sr degrees centered on ra, dec,
+        reading only the needed part of the frame. Returns None if not possible.
+        """
+        if not self.enabled:
+            return None
+
+        header = fits.getheader(filename, -1)
+
+        # Clean up the header from COMMENT and HISTORY keywords that may break things
+        header.remove('COMMENT', remove_all=True, ignore_missing=True)
+        header.remove('HISTORY', remove_all=True, ignore_missing=True)
+
+        geometry = get_cropped_geometry(header)
+        if geometry is None:
+            return None
+
+        wcs = WCS(geometry[3])
+        x0,y0 = wcs.all_world2pix(ra, dec, 0)
+        r0 = sr/np.hypot(wcs.pixel_scale_matrix[0,0], wcs.pixel_scale_matrix[0,1])
+
+        # Same box as stdpipe.cutouts.crop_image_centered
+        x1,y1 = int(np.round(x0) - np.ceil(r0)), int(np.round(y0) - np.ceil(r0))
+        size = 2*int(np.ceil(r0)) + 1
+
+        return self.process_region(filename, x1, y1, size, size, header=header, geometry=geometry)
@@ -0,0 +1,417 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.db.models.expressions import RawSQL
+
+import numpy as np
+import json
+import struct
+import hashlib
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from .models import Images, Photometry
+from .utils import single_flight
+
+
+# Light curve columns as fetched from the database, and their types
+LC_COLUMNS = {
+    'epoch': np.float64,
+    'night': str,
+    'site': str,
+    'ccd': str,
+    'filter': str,
+    'ra': np.float64,
+    'dec': np.float64,
+    'mag': np.float64,
+    'magerr': np.float64,
+    'flags': np.float64,
+    'fwhm': np.float64,
+    'std': np.float64,
+    'nstars': np.float64,
+}
+
+# MJD of Unix epoch
+MJD_EPOCH = 40587.0
+
+
+def iter_lc(lc, chunk_size=10000, server_side=False):
+    """
+    Yield the points of light curve queryset in chunks, as dicts of typed NumPy arrays,
+    reading the cursor directly without instantiating the models. With server_side=True,
+    the rows are fetched from a server-side cursor, so memory use does not depend on the query size.
+
+    Besides the columns from LC_COLUMNS, chunks contain 'time' as datetime64 in UTC and 'mjd'.
+    """
+    qs = lc.annotate(epoch=RawSQL("extract(epoch from time)", ())).values_list(*LC_COLUMNS)
+    sql,params = qs.query.sql_with_params()
+
+    connection = connections[qs.db]
+    cursor = connection.chunked_cursor() if server_side else connection.cursor()
+
+    with cursor:
+        cursor.execute(sql, params)
+        names = [_[0] for _ in cursor.description]
+
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+
+            chunk = {name:np.array(values, dtype=LC_COLUMNS[name]) for name,values in zip(names, zip(*rows))}
+
+            yield add_times(chunk)
+
+
+def add_times(data):
+    """
+    Add 'time' as datetime64 in UTC and 'mjd' columns derived from 'epoch'
+    """
+    data['time'] = np.round(data['epoch']*1e6).astype('datetime64[us]')
+    data['mjd'] = data['epoch']/86400 + MJD_EPOCH
+
+    return data
+
+
+def fetch_lc(lc, chunk_size=10000):
+    """
+    Fetch all points of light curve queryset as a dict of typed NumPy arrays, see iter_lc()
+    """
+    chunks = list(iter_lc(lc, chunk_size=chunk_size))
+
+    data = {}
+
+    for name,dtype in list(LC_COLUMNS.items()) + [('time', 'datetime64[us]'), ('mjd', np.float64)]:
+        if chunks:
+            data[name] = np.concatenate([_[name] for _ in chunks])
+        else:
+            data[name] = np.array([], dtype=dtype)
+
+    return data
+
+
+def format_times(times, sep=' '):
+    """
+    ISO representation of UTC datetime64 array, with explicit time zone
+    """
+    strings = np.datetime_as_string(times, unit='us')
+
+    if sep != 'T':
+        strings = np.char.replace(strings, 'T', sep)
+
+    return np.char.add(strings, '+00:00')
+
+
+def format_lines(columns, chunk_size=10000):
+    """
+    Yield whitespace-separated text lines for the columns, in chunks of given number of lines
+    """
+    for i in range(0, len(columns[0]) if columns else 0, chunk_size):
+        rows = zip(*[np.asarray(_[i:i + chunk_size]).tolist() for _ in columns])
+
+        yield ''.join(' '.join(map(str, row)) + '\n' for row in rows)
+
+
+def format_lc_text(chunks, chunk_size=10000):
+    """
+    Light curve chunks as a text table
+    """
+    yield '# Date Time MJD Site CCD Filter Mag Magerr Flags FWHM Std Nstars\n'
+
+    for chunk in chunks:
+        yield from format_lines(
+            [format_times(chunk['time']), chunk['mjd'], chunk['site'], chunk['ccd'], chunk['filter'],
+             chunk['mag'], chunk['magerr'], chunk['flags'], chunk['fwhm'], chunk['std'], chunk['nstars']],
+            chunk_size=chunk_size
+        )
+
+
+def stream_lc_text(lc, chunk_size=10000):
+    """
+    Full light curve as a text table, streamed from server-side cursor
+    """
+    return format_lc_text(iter_lc(lc, chunk_size=chunk_size, server_side=True), chunk_size=chunk_size)
+
+
+def pack_lc(data):
+    """
+    Compact columnar form of the light curve for caching. String columns are stored
+    as integer codes into the list of their unique values, derived columns are dropped.
+    """
+    packed = {}
+
+    for name,dtype in LC_COLUMNS.items():
+        if dtype is str:
+            values,codes = np.unique(data[name], return_inverse=True)
+            packed[name] = (values, codes.ravel().astype(np.min_scalar_type(max(len(values) - 1, 0))))
+        else:
+            packed[name] = data[name]
+
+    return packed
+
+
+def unpack_lc(packed):
+    """
+    Light curve as a dict of NumPy arrays from its compact form, see pack_lc()
+    """
+    data = {}
+
+    for name,dtype in LC_COLUMNS.items():
+        if dtype is str:
+            values,codes = packed[name]
+            data[name] = values[codes]
+        else:
+            data[name] = packed[name]
+
+    return add_times(data)
+
+
+def latest_night():
+    """
+    Latest night of the images, re-checked every PHOTOMETRY_CACHE_CHECK_INTERVAL seconds.
+    Photometry is derived from the images, so its nights may not be later than that.
+    """
+    night = cache.get('lc:latest_night')
+
+    if night is None:
+        # Served backwards from the images night index, unlike the photometry table
+        night = Images.objects.filter(night__isnull=False).order_by('-night').values_list('night', flat=True).first() or ''
+        cache.set('lc:latest_night', night, settings.PHOTOMETRY_CACHE_CHECK_INTERVAL)
+
+    return night
+
+
+def lc_cache_key(params):
+    return 'lc:' + hashlib.sha1(repr(sorted(params.items())).encode()).hexdigest()
+
+
+def cached_lc(params, lc, fetch=True):
+    """
+    Light curve for the normalized query parameters as a dict of NumPy arrays, see fetch_lc().
+    `lc` is the light curve queryset corresponding to these parameters.
+
+    The results are cached in compact form. Cached light curve is re-validated every
+    PHOTOMETRY_CACHE_CHECK_INTERVAL seconds unless its night range is already complete,
+    and then only the points from the latest cached night onwards are fetched again.
+    Concurrent requests for the same light curve fetch it only once, see single_flight().
+    With fetch=False, returns None instead of fetching the light curve if it is not cached.
+    """
+    if not settings.PHOTOMETRY_CACHE_TIMEOUT:
+        return fetch_lc(lc) if fetch else None
+
+    key = lc_cache_key(params)
+    last = params.get('night') or params.get('night2')
+
+    def lookup():
+        entry = cache.get(key)
+
+        if entry is None:
+            return None
+
+        if (last and last < entry['night']) or time.time() < entry['time'] + settings.PHOTOMETRY_CACHE_CHECK_INTERVAL:
+            return unpack_lc(entry['data'])
+
+    def update():
+        entry = cache.get(key)
+
+        # Nights before the latest one are assumed to be complete
+        night = latest_night()
+
+        if entry is None:
+            data = fetch_lc(lc)
+        else:
+            data = unpack_lc(entry['data'])
+
+            # Re-fetch the points since the latest night of the cached light curve
+            new = fetch_lc(lc.filter(night__gte=entry['night']))
+            keep = data['night'] < entry['night']
+
+            data = {name:np.concatenate([data[name][keep], new[name]]) for name in data}
+
+            order = np.argsort(data['epoch'], kind='stable')
+            data = {name:value[order] for name,value in data.items()}
+
+        if len(data['epoch']) <= settings.PHOTOMETRY_CACHE_MAX_POINTS:
+            cache.set(key, {'night': night, 'time': time.time(), 'data': pack_lc(data)}, settings.PHOTOMETRY_CACHE_TIMEOUT)
+
+        return data
+
+    data = lookup()
+    if data is not None:
+        return data
+
+    if not fetch and cache.get(key) is None:
+        return None
+
+    return single_flight(key, update, lookup)
+
+
+def _segment_searchsorted(a, starts, ends, values):
+    """
+    Vectorized np.searchsorted(a[start:end], value) for every (start, end, value) triplet
+    """
+    lo,hi = starts.copy(), ends.copy()
+
+    while np.any(lo < hi):
+        active = lo < hi
+        mid = (lo + hi)//2
+        right = active & (a[np.minimum(mid, len(a) - 1)] < values)
+
+        lo = np.where(right, mid + 1, lo)
+        hi = np.where(active & ~right, mid, hi)
+
+    return lo - starts
+
+
+def _kth_of_two(first, second, nfirst, nsecond, k):
+    """
+    Vectorized k-th (0-based) smallest element of the union of two ascending sequences,
+    given by accessor functions of element index
+    """
+    lo = np.maximum(0, k + 1 - nsecond)
+    hi = np.minimum(k + 1, nfirst)
+
+    # Bisect on the number of elements taken from the first sequence
+    while np.any(lo < hi):
+        active = lo < hi
+        i = (lo + hi)//2
+        more = active & (first(i) < second(k - i))
+
+        lo = np.where(more, i + 1, lo)
+        hi = np.where(active & ~more, i, hi)
+
+    j = k + 1 - lo
+
+    return np.maximum(np.where(lo > 0, first(lo - 1), -np.inf), np.where(j > 0, second(j - 1), -np.inf))
+
+
+def grouped_clip(values, groups, mask, ngroups, niter=3, nsigma=3.0):
+    """
+    Iterative upper sigma clipping of values[mask] within every group, using median and
+    MAD-based standard deviation, same as median + nsigma*astropy.stats.mad_std() per group.
+    Groups are integer labels in range(ngroups). Returns the updated mask.
+
+    Points are sorted once by group and value, so that the points surviving the clipping
+    always form a prefix of the group segment, and then all groups are clipped together
+    using only index arithmetic on the sorted array.
+    """
+    key = np.where(mask, values, np.inf)
+    order = np.argsort(key)
+    order = order[np.argsort(groups[order].astype(np.min_scalar_type(ngroups)), kind='stable')]
+
+    sorted_values = key[order]
+    last = max(len(values) - 1, 0)
+
+    def at(idx):
+        return sorted_values[np.clip(idx, 0, last)] if len(values) else np.zeros(ngroups)
+
+    starts = np.searchsorted(groups[order], np.arange(ngroups))
+    counts = np.bincount(groups[mask], minlength=ngroups)
+
+    # NaN median rejects the whole group, as np.median() would do
+    counts[np.bincount(groups[mask & np.isnan(values)], minlength=ngroups) > 0] = 0
+
+    limit = np.full(ngroups, np.inf)
+
+    for _ in range(niter):
+        mid1 = starts + (counts - 1)//2
+        mid2 = starts + counts//2
+        median = 0.5*(at(mid1) + at(mid2))
+        median[counts == 0] = np.nan
+
+        # Absolute deviations are ascending going left from the median, and going right after it
+        below = lambda i: median - at(mid1 - i)
+        above = lambda i: at(mid1 + 1 + i) - median
+        nbelow = np.where(counts > 0, (counts - 1)//2 + 1, 0)
+        nabove = counts - nbelow
+
+        mad = 0.5*(_kth_of_two(below, above, nbelow, nabove, (counts - 1)//2) +
+                   _kth_of_two(below, above, nbelow, nabove, counts//2))
+
+        # Same normalization as astropy.stats.mad_std
+        threshold = median + nsigma*(mad*1.482602218505602)
+
+        limit = np.minimum(limit, threshold)
+        counts = _segment_searchsorted(sorted_values, starts, starts + counts, threshold)
+
+    return mask & (values < limit[groups])
+
+
+def quality_mask(data, niter=3, nsigma=3.0):
+    """
+    Quality cuts for the light curve: unflagged points not having outlying
+    background scatter or FWHM with respect to other points in the same filter
+    """
+    names,groups = np.unique(data['filter'], return_inverse=True)
+    groups = groups.ravel()
+
+    mask = data['flags'] < 2
+
+    for name in ['std', 'fwhm']:
+        mask = grouped_clip(data[name], groups, mask, len(names), niter=niter, nsigma=nsigma)
+
+    return mask
+
+
+def _json_default(obj):
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.kind == 'f' and not np.isfinite(obj).all():
+            # Non-finite values are not valid JSON
+            result = obj.astype(object)
+            result[~np.isfinite(obj)] = None
+            return result.tolist()
+
+        return obj.tolist()
+    elif isinstance(obj, np.generic):
+        return obj.item()
+
+    return str(obj)
+
+
+def encode_json(data):
+    """
+    Serialize the data containing NumPy arrays into JSON bytes. Arrays are converted
+    as a whole, using orjson native NumPy support if available, and NaNs become nulls.
+    """
+    if orjson is not None:
+        return orjson.dumps(data, default=_json_default, option=orjson.OPT_SERIALIZE_NUMPY)
+    else:
+        return json.dumps(data, default=_json_default).encode()
+
+
+def encode_binary(data):
+    """
+    Serialize the light curves into compact columnar binary form.
+
+    Layout is a little-endian uint32 length of JSON header, the header itself padded
+    to 8 bytes boundary, and then the columns as little-endian float64 arrays.
+    In the header, every numeric array in data['lcs'] entries is replaced with
+    {'offset': ..., 'length': ...} giving its position in elements after the header.
+    """
+    header = dict(data)
+    header['lcs'] = []
+
+    columns = []
+    offset = 0
+
+    for lc in data['lcs']:
+        hlc = {}
+
+        for key,value in lc.items():
+            if isinstance(value, np.ndarray):
+                columns.append(np.asarray(value, dtype='<f8'))
+                hlc[key] = {'offset': offset, 'length': len(value)}
+                offset += len(value)
+            else:
+                hlc[key] = value
+
+        header['lcs'].append(hlc)
+
+    header = encode_json(header)
+    header += b' '*(-(len(header) + 4) % 8)
+
+    return b''.join([struct.pack('<I', len(header)), header] + [_.tobytes() for _ in columns])
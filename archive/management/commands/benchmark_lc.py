@@ -0,0 +1,77 @@
+from django.core.management.base import BaseCommand
+
+import time
+
+import numpy as np
+from astropy.stats import mad_std
+
+from archive.lightcurves import quality_mask
+
+
+def quality_mask_loop(data, niter=3, nsigma=3.0):
+    """
+    Reference per-filter implementation of the quality cuts
+    """
+    filters,flags,stds,fwhms = [data[_] for _ in ['filter', 'flags', 'std', 'fwhm']]
+
+    idx0 = flags < 2
+    mask = np.zeros_like(idx0)
+
+    for fn in np.unique(filters):
+        idx = idx0 & (filters == fn)
+
+        for _ in range(niter):
+            idx &= stds < np.median(stds[idx]) + nsigma*mad_std(stds[idx])
+
+        for _ in range(niter):
+            idx &= fwhms < np.median(fwhms[idx]) + nsigma*mad_std(fwhms[idx])
+
+        mask |= idx
+
+    return mask
+
+
+def synthetic_lc(size, rng):
+    data = {}
+
+    data['filter'] = rng.choice(np.array(['B', 'V', 'R', 'I', 'z']), size)
+    data['flags'] = rng.choice(np.array([0.0, 1.0, 2.0, 4.0]), size, p=[0.7, 0.2, 0.05, 0.05])
+    data['std'] = np.abs(rng.normal(10, 1, size)) + 20*(rng.random(size) < 0.05)
+    data['fwhm'] = np.abs(rng.normal(2, 0.2, size)) + 5*(rng.random(size) < 0.05)
+
+    return data
+
+
+def timeit(func, repeat=3):
+    times = []
+
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+
+    return min(times)
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks light curve quality cuts on synthetic data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='100000,300000,1000000', help='Comma-separated list of light curve lengths')
+        parser.add_argument('--repeat', type=int, default=3, help='Number of repetitions')
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(1)
+
+        print(f"{'Points':>10} {'loop':>10} {'grouped':>10} {'Speedup':>8} {'Kept':>8} {'Match':>6}")
+
+        for size in [int(_) for _ in options['sizes'].split(',')]:
+            data = synthetic_lc(size, rng)
+
+            t_loop = timeit(lambda: quality_mask_loop(data), repeat=options['repeat'])
+            t_grouped = timeit(lambda: quality_mask(data), repeat=options['repeat'])
+
+            mask = quality_mask(data)
+            match = np.array_equal(mask, quality_mask_loop(data))
+
+            print(f"{size:>10} {t_loop:>9.3f}s {t_grouped:>9.3f}s {t_loop/t_grouped:>7.1f}x {np.sum(mask):>8} {str(match):>6}")
@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+import posixpath
+import time
+
+import numpy as np
+from astropy.io import fits
+
+from archive.models import Images
+from archive import previews
+
+
+def timeit(func, repeat=3):
+    times = []
+
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+
+    return min(times)
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks preview downscaling methods on real or synthetic frames'
+
+    def add_arguments(self, parser):
+        parser.add_argument('ids', nargs='*', type=int, help='Image ids to use, synthetic frames are used if not set')
+        parser.add_argument('--shapes', default='1024x1024,2048x2048,4096x4096', help='Comma-separated list of synthetic frame shapes')
+        parser.add_argument('--sizes', default='128,800', help='Comma-separated list of preview sizes')
+        parser.add_argument('--repeat', type=int, default=3, help='Number of repetitions')
+
+    def handle(self, *args, **options):
+        sizes = [int(_) for _ in options['sizes'].split(',')]
+
+        frames = []
+
+        if options['ids']:
+            for image in Images.objects.filter(id__in=options['ids']):
+                data = fits.getdata(posixpath.join(settings.BASE_DIR, image.filename), -1).astype(np.float32)
+                frames.append((f"image {image.id}", data))
+        else:
+            rng = np.random.default_rng(1)
+            for shape in options['shapes'].split(','):
+                height,width = [int(_) for _ in shape.split('x')]
+                data = rng.normal(1000, 10, (height, width)).astype(np.float32)
+                frames.append((f"synthetic {width}x{height}", data))
+
+        print(f"{'Frame':>24} {'Size':>6} " + ' '.join(f"{_:>10}" for _ in previews.RESAMPLE_METHODS) + f" {'Speedup':>8} {'RMS diff':>10}")
+
+        for name,data in frames:
+            for size in sizes:
+                results = {}
+                times = {}
+
+                for method in previews.RESAMPLE_METHODS:
+                    times[method] = timeit(lambda: previews.downscale(data, size, method=method), repeat=options['repeat'])
+                    results[method] = previews.downscale(data, size, method=method)
+
+                # RMS difference relative to the pixel scatter of the exact result
+                exact = results['exact']
+                diff = np.sqrt(np.nanmean((results['area'] - exact)**2)) / np.nanstd(exact)
+
+                print(f"{name:>24} {size:>6} " + ' '.join(f"{times[_]:>9.3f}s" for _ in previews.RESAMPLE_METHODS) + f" {times['exact']/times['area']:>7.1f}x {diff:>10.3g}")
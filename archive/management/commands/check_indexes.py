@@ -0,0 +1,85 @@
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+import re
+
+
+# Indexes the archive queries rely on: name, table, method, key, required extension, and what uses them
+INDEXES = [
+    ('images_site_night_idx', 'images', 'btree', 'site, night', None, 'site and night filters, nightly summaries, sorting by site'),
+    ('images_night_idx', 'images', 'btree', 'night', None, 'night ranges, sorting by night'),
+    ('images_time_id_idx', 'images', 'btree', 'time, id', None, 'default ordering and keyset pagination'),
+    ('images_filename_idx', 'images', 'btree', 'filename', None, 'sorting by filename'),
+    ('images_filename_trgm_idx', 'images', 'gin', 'filename gin_trgm_ops', 'pg_trgm', 'filename substring search'),
+    ('images_q3c_idx', 'images', 'btree', 'q3c_ang2ipix(ra, dec)', 'q3c', 'positional searches and cutouts'),
+    ('calibrations_site_night_idx', 'calibrations', 'btree', 'site, night', None, 'calibration frames lookup'),
+    ('photometry_q3c_idx', 'photometry', 'btree', 'q3c_ang2ipix(ra, dec)', 'q3c', 'light curves'),
+]
+
+
+def normalize(sql):
+    return re.sub(r'\s+', ' ', sql.lower().replace('"', '')).strip()
+
+
+def is_covered(method, key, indexdefs):
+    """
+    Whether any of the existing indexes has the same method and starts with the same key columns
+    """
+    pattern = re.escape(normalize(f"using {method} ({key}")) + r'[,)]'
+
+    return any(re.search(pattern, normalize(_)) for _ in indexdefs)
+
+
+def create_statement(name, table, method, key):
+    return f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} USING {method} ({key});"
+
+
+class Command(BaseCommand):
+    help = 'Reports the indexes of the observational database needed by the archive queries, and SQL to create the missing ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sql', action='store_true', help='Print only the SQL creating missing indexes, e.g. to pipe it into psql')
+        parser.add_argument('--all', action='store_true', help='Print the SQL for all indexes without checking the database')
+
+    def handle(self, *args, **options):
+        if options['all']:
+            for extension in sorted(set(_[4] for _ in INDEXES if _[4])):
+                print(f"CREATE EXTENSION IF NOT EXISTS {extension};")
+
+            for name,table,method,key,extension,usage in INDEXES:
+                print(create_statement(name, table, method, key))
+
+            return
+
+        with connections['fram'].cursor() as cursor:
+            cursor.execute("SELECT tablename, indexdef FROM pg_indexes WHERE tablename = ANY(%s)", (list(set(_[1] for _ in INDEXES)),))
+            indexdefs = {}
+            for table,indexdef in cursor.fetchall():
+                indexdefs.setdefault(table, []).append(indexdef)
+
+            cursor.execute("SELECT extname FROM pg_extension")
+            extensions = set(_[0] for _ in cursor.fetchall())
+
+        missing = []
+
+        for name,table,method,key,extension,usage in INDEXES:
+            if is_covered(method, key, indexdefs.get(table, [])):
+                if not options['sql']:
+                    print(f"OK       {table} ({key}) - {usage}")
+            else:
+                missing.append((name, table, method, key, extension))
+                if not options['sql']:
+                    print(f"MISSING  {table} ({key}) - {usage}")
+
+        if not missing:
+            return
+
+        if not options['sql']:
+            print()
+            print("SQL to create the missing indexes:")
+
+        for extension in sorted(set(_[4] for _ in missing if _[4] and _[4] not in extensions)):
+            print(f"CREATE EXTENSION IF NOT EXISTS {extension};")
+
+        for name,table,method,key,extension in missing:
+            print(create_statement(name, table, method, key))
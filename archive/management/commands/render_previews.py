@@ -0,0 +1,82 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import connections
+
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from archive.models import Images
+from archive import previews
+
+
+def render_image(id, sizes):
+    image = Images.objects.get(id=id)
+
+    for size in sizes:
+        previews.get_preview(image, size=size, store=True)
+
+
+def render_chunk(ids, sizes):
+    failed = []
+
+    for id in ids:
+        try:
+            render_image(id, sizes)
+        except Exception as e:
+            failed.append((id, str(e)))
+
+    return len(ids), failed
+
+
+class Command(BaseCommand):
+    help = 'Pre-renders image previews into the on-disk store'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--night', nargs='*', help='Nights to process')
+        parser.add_argument('--last', type=int, default=1, help='Process given number of latest nights if no nights are specified')
+        parser.add_argument('--site', help='Process only given site')
+        parser.add_argument('--sizes', default=None, help='Comma-separated list of preview sizes')
+        parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Number of parallel processes')
+
+    def handle(self, *args, **options):
+        if not settings.PREVIEWS_PATH:
+            raise CommandError('PREVIEWS_PATH is not set')
+
+        if options['sizes']:
+            sizes = [int(_) for _ in options['sizes'].split(',')]
+        else:
+            sizes = settings.PREVIEWS_STORED_SIZES
+
+        images = Images.objects.all()
+
+        if options['site']:
+            images = images.filter(site=options['site'])
+
+        nights = options['night']
+        if not nights:
+            nights = list(images.order_by('-night').values_list('night', flat=True).distinct()[:options['last']])
+
+        ids = list(images.filter(night__in=nights).order_by('time').values_list('id', flat=True))
+
+        print(f"Rendering {len(ids)} images from {len(nights)} nights, sizes {sizes}")
+
+        # Images from the same night are processed together to share calibration frames
+        chunks = [ids[_:_ + 50] for _ in range(0, len(ids), 50)]
+
+        # Do not let forked workers inherit open database connections
+        connections.close_all()
+
+        processed = 0
+        with ProcessPoolExecutor(max_workers=options['jobs']) as executor:
+            futures = [executor.submit(render_chunk, chunk, sizes) for chunk in chunks]
+
+            for future in as_completed(futures):
+                count,failed = future.result()
+                processed += count
+
+                for id,error in failed:
+                    print(f"Error rendering image {id}: {error}")
+
+                print(f"{processed} / {len(ids)} images processed")
+
+        previews.prune_store()
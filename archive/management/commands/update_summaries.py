@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from archive import summaries
+
+
+class Command(BaseCommand):
+    help = 'Incrementally updates the per-night and per-site summaries of the images table. Run it after ingesting new images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--site', nargs='*', help='Update only given sites')
+        parser.add_argument('--since', help='Also re-scan the nights starting from this one')
+        parser.add_argument('--full', action='store_true', help='Rebuild the summaries from scratch')
+
+    def handle(self, *args, **options):
+        for summary in summaries.update_site_summaries(sites=options['site'], since=options['since'], full=options['full']):
+            print(f"{summary.site}: {summary.count} images from {summary.first_night} to {summary.last_night}, "
+                  f"last one at {summary.last_time}, {len(summary.types)} types, {len(summary.filters)} filters, {len(summary.ccds)} ccds, {len(summary.serials)} serials")
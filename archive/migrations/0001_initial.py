@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SiteSummary',
+            fields=[
+                ('site', models.TextField(primary_key=True, serialize=False)),
+                ('count', models.BigIntegerField(default=0)),
+                ('first_night', models.TextField(blank=True, null=True)),
+                ('last_night', models.TextField(blank=True, null=True)),
+                ('last_night_count', models.BigIntegerField(default=0)),
+                ('types', models.JSONField(default=list)),
+                ('filters', models.JSONField(default=list)),
+                ('ccds', models.JSONField(default=list)),
+                ('serials', models.JSONField(default=list)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['site'],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('archive', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sitesummary',
+            name='last_time',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('archive', '0002_sitesummary_last_time'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NightSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('night', models.TextField()),
+                ('site', models.TextField()),
+                ('count', models.BigIntegerField(default=0)),
+                ('exposure', models.FloatField(default=0)),
+                ('last_time', models.DateTimeField(blank=True, null=True)),
+                ('types', models.JSONField(default=dict)),
+                ('filters', models.JSONField(default=dict)),
+                ('ccds', models.JSONField(default=dict)),
+                ('serials', models.JSONField(default=list)),
+                ('calibrations', models.JSONField(default=dict)),
+            ],
+            options={
+                'ordering': ['-night', 'site'],
+                'indexes': [models.Index(fields=['site', 'night'], name='archive_nig_site_09155f_idx')],
+                'unique_together': {('night', 'site')},
+            },
+        ),
+    ]
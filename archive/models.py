@@ -92,3 +92,53 @@ class Photometry(models.Model):
         managed = False
         db_table = 'photometry'
         app_label = 'fram'
+
+
+# Models below are managed by Django and kept in the default database
+
+
+class SiteSummary(models.Model):
+    """
+    Per-site summary of the images table, with distinct values of the search fields.
+    Maintained incrementally by summaries.update_site_summaries()
+    """
+    site = models.TextField(primary_key=True)
+    count = models.BigIntegerField(default=0)
+    first_night = models.TextField(blank=True, null=True)
+    last_night = models.TextField(blank=True, null=True)
+    # Number of images in the last night, to update the counts when it is re-scanned
+    last_night_count = models.BigIntegerField(default=0)
+    last_time = models.DateTimeField(blank=True, null=True)
+    types = models.JSONField(default=list)
+    filters = models.JSONField(default=list)
+    ccds = models.JSONField(default=list)
+    serials = models.JSONField(default=list)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['site']
+
+
+class NightSummary(models.Model):
+    """
+    Per-night and per-site rollup of the images and calibrations tables.
+    Maintained incrementally by summaries.update_site_summaries()
+    """
+    night = models.TextField()
+    site = models.TextField()
+    count = models.BigIntegerField(default=0)
+    # Total exposure time of all images, in seconds
+    exposure = models.FloatField(default=0)
+    last_time = models.DateTimeField(blank=True, null=True)
+    # Numbers of images per value of the field
+    types = models.JSONField(default=dict)
+    filters = models.JSONField(default=dict)
+    ccds = models.JSONField(default=dict)
+    serials = models.JSONField(default=list)
+    # Numbers of calibration frames per type
+    calibrations = models.JSONField(default=dict)
+
+    class Meta:
+        ordering = ['-night', 'site']
+        unique_together = [('night', 'site')]
+        indexes = [models.Index(fields=['site', 'night'])]
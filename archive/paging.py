@@ -0,0 +1,183 @@
+from django.db import connections
+from django.db.models import Q
+from django.template.loader import get_template
+
+import datetime
+import json
+
+
+# Fields the image lists may be sorted on
+SORT_FIELDS = ['time', 'id', 'night', 'site', 'filter', 'type', 'ccd', 'serial', 'exposure', 'target', 'filename']
+
+# Orderings backed by the indexes, see check_indexes command, for every field they may start with
+INDEXED_SORTS = {
+    'time': ['time', 'id'],
+    'id': ['id'],
+    'night': ['night', 'time', 'id'],
+    'site': ['site', 'night', 'time', 'id'],
+    # Needs btree index, trigram one used for searching can not serve the ordering
+    'filename': ['filename'],
+}
+
+# Default ordering, paginated by keyset
+DEFAULT_SORT = ['-time', '-id']
+
+
+def plan_sort(sort, small=False, fields=SORT_FIELDS):
+    """
+    Ordering for the comma-separated sort spec, and the message if it had to be changed.
+
+    Sorts on a single indexed field are expanded to their full index ordering. Other whitelisted
+    combinations are only allowed if the result is `small`, otherwise the default ordering is used
+    so that the whole table is never sorted. Unknown fields are rejected.
+    """
+    keys = [_.strip() for _ in (sort or '').split(',') if _.strip()]
+
+    if not keys:
+        return DEFAULT_SORT, None
+
+    for key in keys:
+        if key.lstrip('-') not in fields:
+            return DEFAULT_SORT, f"Cannot sort by {key.lstrip('-')}"
+
+    if len(keys) == 1 and keys[0].lstrip('-') in INDEXED_SORTS:
+        prefix = '-' if keys[0].startswith('-') else ''
+        return [prefix + _ for _ in INDEXED_SORTS[keys[0].lstrip('-')]], None
+
+    if not small:
+        return DEFAULT_SORT, f"Sorting by {','.join(keys)} is only possible for smaller results, please refine the query"
+
+    if 'id' not in [_.lstrip('-') for _ in keys]:
+        # Stable order for pagination
+        keys.append('id')
+
+    return keys, None
+
+
+def planner_count(queryset):
+    """
+    Number of rows in the queryset as estimated by the query planner, or None if not available
+    """
+    try:
+        sql,params = queryset.order_by().query.sql_with_params()
+
+        with connections[queryset.db].cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+
+        return int(plan[0]['Plan']['Plan Rows'])
+    except Exception:
+        return None
+
+
+def fast_count(queryset, limit=10000):
+    """
+    Number of rows in the queryset, and whether it is exact. Only up to `limit` rows are
+    actually counted, for larger results the planner estimate is returned instead.
+    """
+    count = queryset.order_by()[:limit + 1].count()
+
+    if count <= limit:
+        return count, True
+
+    estimate = planner_count(queryset)
+
+    return max(count, estimate or 0), False
+
+
+def format_cursor(item):
+    return item.time.isoformat() + ',' + str(item.id)
+
+
+def parse_cursor(cursor):
+    """
+    Time and id from the cursor, or None if it is malformed
+    """
+    try:
+        time,id = cursor.rsplit(',', 1)
+
+        return datetime.datetime.fromisoformat(time), int(id)
+    except ValueError:
+        return None
+
+
+class KeysetPage:
+    """
+    Page of the queryset ordered by descending (time, id), with the cursors of
+    the neighbouring pages. Cursors are None if there are no such pages.
+    """
+
+    def __init__(self, items, newer=None, older=None, first=True):
+        self.items = items
+        self.newer = newer
+        self.older = older
+        self.first = first
+
+
+def keyset_page(queryset, size, after=None, before=None):
+    """
+    Page of `size` items from the queryset in the default -time order, starting right after
+    (older than) or ending right before (newer than) the item identified by the cursor.
+    Seeks directly to the position using (time, id) index, so that deep pages are as fast as
+    the first one. Items without time are never shown.
+    """
+    queryset = queryset.filter(time__isnull=False)
+
+    before = parse_cursor(before) if before else None
+    after = parse_cursor(after) if after else None
+
+    if before:
+        time,id = before
+        items = list(queryset.filter(Q(time__gt=time) | Q(time=time, id__gt=id)).order_by('time', 'id')[:size + 1])
+
+        has_newer = len(items) > size
+        items = items[:size][::-1]
+        has_older = True
+    else:
+        if after:
+            time,id = after
+            queryset = queryset.filter(Q(time__lt=time) | Q(time=time, id__lt=id))
+
+        items = list(queryset.order_by('-time', '-id')[:size + 1])
+
+        has_newer = bool(after)
+        has_older = len(items) > size
+        items = items[:size]
+
+    return KeysetPage(
+        items,
+        newer=format_cursor(items[0]) if items and has_newer else None,
+        older=format_cursor(items[-1]) if items and has_older else None,
+        first=not has_newer,
+    )
+
+
+def stream_template(request, template_name, context, rows_template_name, items, chunk_size=100):
+    """
+    Render the page piece by piece, with `items` rendered by a separate template in chunks,
+    so that they are never all in memory. The page template should output `rows_marker`
+    from the context in place of the rows.
+    """
+    marker = '<!-- rows -->'
+    page = get_template(template_name).render(dict(context, rows_marker=marker), request)
+    head,tail = page.split(marker, 1)
+
+    rows_template = get_template(rows_template_name)
+
+    yield head
+
+    chunk = []
+    for item in items:
+        chunk.append(item)
+
+        if len(chunk) == chunk_size:
+            yield rows_template.render(dict(context, images=chunk), request)
+            chunk = []
+
+    if chunk:
+        yield rows_template.render(dict(context, images=chunk), request)
+
+    yield tail
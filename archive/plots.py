@@ -0,0 +1,139 @@
+import threading
+
+import numpy as np
+import cv2
+
+
+# Output formats for plots - file extension and content type
+PLOT_FORMATS = {
+    'jpeg': ('.jpg', 'image/jpeg'),
+    'png': ('.png', 'image/png'),
+    'webp': ('.webp', 'image/webp'),
+}
+
+FILTER_COLORS = {'B':'blue', 'V':'green', 'R':'red', 'I':'orange', 'z':'magenta'}
+
+_local = threading.local()
+
+
+def get_figure(name, figsize, dpi=72, setup=None):
+    """
+    Template figure reused by all requests of current thread, with Agg canvas attached.
+
+    The figure is created on first use, and setup(fig) is called to add the static
+    elements to it. Returns the figure and whatever setup() returned.
+    Matplotlib is imported only here, when the first plot is actually needed.
+    """
+    figures = _local.__dict__.setdefault('figures', {})
+    key = (name, tuple(figsize), dpi)
+
+    if key not in figures:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        fig = Figure(facecolor='white', dpi=dpi, figsize=figsize)
+        FigureCanvasAgg(fig)
+
+        figures[key] = (fig, setup(fig) if setup is not None else None)
+
+    return figures[key]
+
+
+def blank_figure(figsize, dpi=72):
+    """
+    Empty reusable figure with tight layout, for plots with variable layout
+    """
+    fig,_ = get_figure('blank', figsize, dpi=dpi, setup=lambda fig: fig.set_layout_engine('tight'))
+    fig.clear()
+
+    return fig
+
+
+def render_figure(fig, format='jpeg', quality=75):
+    """
+    Draw the figure and encode it as JPEG, PNG or WebP. Returns bytes, or None on failure
+    """
+    ext,_ = PLOT_FORMATS[format]
+
+    fig.canvas.draw()
+    data = cv2.cvtColor(np.asarray(fig.canvas.buffer_rgba()), cv2.COLOR_RGBA2BGR)
+
+    if format == 'jpeg':
+        params = [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+    elif format == 'webp':
+        params = [cv2.IMWRITE_WEBP_QUALITY, int(quality)]
+    else:
+        params = []
+
+    success, buf = cv2.imencode(ext, data, params)
+    if not success:
+        return None
+
+    return buf.tobytes()
+
+
+def _setup_lc(fig):
+    ax = fig.add_subplot(111)
+    ax.grid(True, alpha=0.1, color='gray')
+    ax.xaxis_date()
+
+    fig.subplots_adjust(left=0.06, right=0.98, bottom=0.08, top=0.93)
+
+    return {'ax': ax, 'artists': []}
+
+
+def plot_lc(lcs, title='', size=800, format='jpeg', quality=75):
+    """
+    Plot the light curves given as a list of (color, times, mags, magerrs) tuples,
+    with times as datetime64. Only the data artists of the template figure are updated.
+    """
+    from matplotlib.collections import LineCollection
+    from matplotlib.dates import date2num
+
+    fig,state = get_figure('lc', (size/72, 0.5*size/72), setup=_setup_lc)
+    ax,artists = state['ax'], state['artists']
+
+    xlim,ylim = [], []
+
+    # Filters without any finite magnitudes have nothing to plot
+    lcs = [_ for _ in lcs if np.any(np.isfinite(_[2]))]
+
+    for i,(color,times,mags,magerrs) in enumerate(lcs):
+        if i == len(artists):
+            bars = LineCollection([], alpha=0.3)
+            ax.add_collection(bars)
+            points, = ax.plot([], [], '.', ls='')
+            artists.append((bars, points))
+
+        bars,points = artists[i]
+        x = date2num(times)
+
+        bars.set_segments(np.stack([np.stack([x, mags - magerrs], axis=-1), np.stack([x, mags + magerrs], axis=-1)], axis=1))
+        bars.set_color(color)
+        points.set_data(x, mags)
+        points.set_color(color)
+
+        xlim += [np.nanmin(x), np.nanmax(x)]
+
+        # Limits from finite values only, errors may be missing
+        lower,upper = mags - magerrs, mags + magerrs
+        good = np.isfinite(lower) & np.isfinite(upper)
+        if not np.any(good):
+            lower,upper,good = mags, mags, np.isfinite(mags)
+
+        ylim += [np.min(lower[good]), np.max(upper[good])]
+
+    for i,(bars,points) in enumerate(artists):
+        bars.set_visible(i < len(lcs))
+        points.set_visible(i < len(lcs))
+
+    if xlim:
+        # Fixed limits instead of autoscaling, with magnitudes increasing downwards
+        dx = max(0.02*(max(xlim) - min(xlim)), 0.01)
+        dy = max(0.05*(max(ylim) - min(ylim)), 0.01)
+        ax.set_xlim(min(xlim) - dx, max(xlim) + dx)
+        ax.set_ylim(max(ylim) + dy, min(ylim) - dy)
+
+    ax.set_title(title)
+
+    return render_figure(fig, format=format, quality=quality)
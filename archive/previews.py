@@ -0,0 +1,263 @@
+from django.conf import settings
+from django.core.cache import cache
+
+import os, posixpath
+import hashlib
+import tempfile
+
+import numpy as np
+import cv2
+
+from skimage.transform import rescale
+
+from astropy.io import fits
+
+from .calibrations import CalibrationPipeline
+from .streams import prune_directory
+
+# FRAM modules
+from fram import calibrate
+
+
+# Methods for estimating the stretch limits
+STRETCH_METHODS = ['sample', 'exact']
+
+# How long to keep the stretch limits of an image in the cache, in seconds
+STRETCH_CACHE_TIMEOUT = 7*86400
+
+# Rendering parameters of the previews kept in the on-disk store
+STORED_PARAMS = {'qq': [2.5, 99.75], 'cmap': 'Blues_r', 'quality': 75, 'resample': 'area', 'stretch': 'sample'}
+
+# How often, in number of stored previews per process, to prune the store
+PRUNE_EVERY = 1000
+
+
+def stretch_limits(data, qq=[2.5, 99.75], method='sample', max_samples=100000):
+    """
+    Percentiles of finite pixel values used to stretch the image.
+
+    'sample' estimates them on a regular strided subsample of at most max_samples pixels,
+    'exact' uses all pixels of the image.
+    """
+    if method == 'sample' and data.size > max_samples:
+        step = int(np.ceil(np.sqrt(data.size/max_samples)))
+        data = data[::step, ::step]
+
+    data = data[np.isfinite(data)]
+    if not data.size:
+        return np.array([0.0, 1.0])
+
+    return np.percentile(data, qq)
+
+
+_luts = {}
+
+
+def colormap_lut(name):
+    """
+    Colormap as 256-entry BGR lookup table suitable for cv2.applyColorMap, and its color for invalid values
+    """
+    if name not in _luts:
+        from matplotlib import colormaps
+
+        cmap = colormaps[name]
+
+        lut = (255 * cmap(np.arange(256) / 255)).astype(np.uint8)
+        bad = (255 * np.array(cmap.get_bad())).astype(np.uint8)
+
+        _luts[name] = (np.ascontiguousarray(lut[:, 2::-1]).reshape(256, 1, 3), bad[2::-1])
+
+    return _luts[name]
+
+
+def colorize(data, qq=[2.5, 99.75], cmap='Blues_r', stretch='sample', limits=None):
+    """
+    Stretch the image and apply the colormap, returning 8-bit BGR image
+    """
+    if limits is None:
+        limits = stretch_limits(data, qq, method=stretch)
+
+    lut,bad = colormap_lut(cmap)
+
+    # Quantize the stretched image into colormap indices
+    scaled = np.subtract(data, limits[0], dtype=np.float32)
+    scaled *= 256 / (limits[1] - limits[0])
+    np.clip(scaled, 0, 255, out=scaled)
+
+    invalid = np.isnan(scaled)
+    if invalid.any():
+        scaled[invalid] = 0
+    else:
+        invalid = None
+
+    index = scaled.astype(np.uint8)
+
+    data = cv2.applyColorMap(index, lut) # BGR
+
+    if invalid is not None:
+        data[invalid] = bad
+
+    return data
+
+
+def render_jpeg(data, qq=[2.5, 99.75], cmap='Blues_r', quality=75, stretch='sample', limits=None):
+    """
+    Stretch the image, apply the colormap and encode it as JPEG. Returns bytes, or None on failure
+    """
+    data = colorize(data, qq=qq, cmap=cmap, stretch=stretch, limits=limits)
+
+    success, buf = cv2.imencode(
+        ".jpg",
+        data,
+        [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+    )
+    if not success:
+        return None
+
+    return buf.tobytes()
+
+
+# Downscaling methods for previews
+RESAMPLE_METHODS = ['area', 'exact']
+
+
+def downscale(data, size, method='area'):
+    """
+    Resize the image to a given width.
+
+    'area' averages the pixels falling into every output pixel on a float32 buffer,
+    which is an exact block average for integer scale factors, and is much faster
+    than 'exact' anti-aliased skimage rescaling. Upscaling always uses 'exact'.
+    """
+    scale = size/data.shape[1]
+
+    if method == 'area' and scale < 1:
+        height = max(1, int(round(data.shape[0]*scale)))
+        return cv2.resize(np.asarray(data, dtype=np.float32), (size, height), interpolation=cv2.INTER_AREA)
+    else:
+        return rescale(data, scale, mode='reflect', anti_aliasing=True, preserve_range=True)
+
+
+def preview_inputs(image, raw=False, pipeline=None):
+    """
+    Everything the preview pixels depend upon besides rendering parameters. Calibration frames
+    are identified by their contents too, so masters regenerated in place invalidate the previews.
+    """
+    if raw:
+        filename = posixpath.join(settings.BASE_DIR, image.filename)
+
+        return (image.id, os.path.getmtime(filename), True, ())
+
+    if pipeline is None:
+        pipeline = CalibrationPipeline(image)
+
+    id,mtime,calibs = pipeline.identity()
+
+    return (id, mtime, False, calibs)
+
+
+def render_preview(image, size=0, qq=[2.5, 99.75], cmap='Blues_r', quality=75, raw=False, resample='area', stretch='sample', pipeline=None):
+    """
+    Read the image from disk, calibrate, downscale to given width and encode as JPEG.
+    Stretch limits are computed on the full resolution calibrated image, and cached
+    so that all preview sizes and colormaps of the image share them.
+    """
+    filename = posixpath.join(settings.BASE_DIR, image.filename)
+
+    if not raw and pipeline is None:
+        pipeline = CalibrationPipeline(image)
+
+    data = fits.getdata(filename, -1)
+    header = fits.getheader(filename, -1)
+
+    if not raw:
+        data,header = pipeline.apply(data, header)
+    else:
+        data,header = calibrate.crop_overscans(data, header, subtract=False)
+
+    key = preview_inputs(image, raw=raw, pipeline=pipeline) + (tuple(float(_) for _ in qq), stretch)
+    key = 'stretch:' + hashlib.sha1(repr(key).encode()).hexdigest()
+
+    limits = cache.get(key)
+    if limits is None:
+        limits = stretch_limits(data, qq, method=stretch)
+        cache.set(key, limits, STRETCH_CACHE_TIMEOUT)
+
+    if size:
+        data = downscale(data, size, method=resample)
+
+    return render_jpeg(data, qq=qq, cmap=cmap, quality=quality, limits=limits)
+
+
+def preview_key(image, size=0, qq=[2.5, 99.75], cmap='Blues_r', quality=75, raw=False, resample='area', stretch='sample', pipeline=None):
+    """
+    Content address of the preview - hash of everything its pixels depend upon
+    """
+    key = preview_inputs(image, raw=raw, pipeline=pipeline) + (int(size), tuple(float(_) for _ in qq), cmap, int(quality), resample, stretch)
+
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+def preview_path(key):
+    return os.path.join(settings.PREVIEWS_PATH, key[:2], key + '.jpg')
+
+
+def get_preview(image, size=0, qq=[2.5, 99.75], cmap='Blues_r', quality=75, raw=False, resample='area', stretch='sample', store=None):
+    """
+    JPEG preview of the image, taken from the on-disk store if available.
+    Newly rendered previews are stored if their size is in PREVIEWS_STORED_SIZES
+    and they are rendered with default parameters, see STORED_PARAMS.
+    """
+    pipeline = None if raw else CalibrationPipeline(image)
+
+    if store is None:
+        params = {'qq': [float(_) for _ in qq], 'cmap': cmap, 'quality': int(quality), 'resample': resample, 'stretch': stretch}
+        store = bool(settings.PREVIEWS_PATH) and size in settings.PREVIEWS_STORED_SIZES and params == STORED_PARAMS
+
+    if store:
+        path = preview_path(preview_key(image, size=size, qq=qq, cmap=cmap, quality=quality, raw=raw, resample=resample, stretch=stretch, pipeline=pipeline))
+
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+
+    buf = render_preview(image, size=size, qq=qq, cmap=cmap, quality=quality, raw=raw, resample=resample, stretch=stretch, pipeline=pipeline)
+
+    if store and buf is not None:
+        store_file(path, buf)
+
+        _stored[0] += 1
+        if _stored[0] % PRUNE_EVERY == 0:
+            prune_store()
+
+    return buf
+
+
+_stored = [0]
+
+
+def prune_store():
+    """
+    Remove least recently written previews so that the store fits PREVIEWS_STORE_SIZE
+    """
+    if settings.PREVIEWS_PATH:
+        prune_directory(settings.PREVIEWS_PATH, settings.PREVIEWS_STORE_SIZE*1024**3)
+
+
+def store_file(path, contents):
+    """
+    Atomically write the file, so that concurrent readers never see partial contents
+    """
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+
+    fd,tmpname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(contents)
+        os.replace(tmpname, path)
+    except:
+        os.unlink(tmpname)
+        raise
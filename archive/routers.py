@@ -18,6 +18,12 @@ class ArchiveRouter(object):
             return True
         return False
 
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Legacy tables are never migrated, and our own models live in default database
+        if app_label == 'fram':
+            return False
+        return db == 'default'
+
     def allow_syncdb(self, db, model):
         if db == 'fram' or model._meta.app_label == "fram":
             return False # we're not using syncdb on our legacy database
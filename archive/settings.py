@@ -119,12 +119,21 @@ DATABASES = {
 
 DATABASE_ROUTERS = ['archive.routers.ArchiveRouter']
 
+# Cache shared by all worker processes, empty path to use per-process memory cache,
+# and its size in megabytes
+CACHE_PATH = config('CACHE_PATH', default=str(BASE_DIR / 'cache.sqlite3'), cast=str)
+CACHE_SIZE = config('CACHE_SIZE', default=2048, cast=int)
+
 CACHES = {
     # 'default': {
     #     'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
     #     'LOCATION': '/tmp/django_cache_fram',
     # }
     "default": {
+        "BACKEND": "archive.cache.SQLiteCache",
+        "LOCATION": CACHE_PATH,
+        "OPTIONS": {"MAX_SIZE": CACHE_SIZE*1024**2},
+    } if CACHE_PATH else {
         "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
         "LOCATION": "unique-snowflake",
     }
@@ -133,6 +142,47 @@ CACHES = {
     # }
 }
 
+# Calibration frames lookup cache, per worker process
+CALIBRATION_LOOKUP_CACHE_SIZE = config('CALIBRATION_LOOKUP_CACHE_SIZE', default=4096, cast=int)
+CALIBRATION_LOOKUP_CACHE_TIMEOUT = config('CALIBRATION_LOOKUP_CACHE_TIMEOUT', default=3600, cast=int)
+
+# Decoded calibration frames cache, in megabytes per worker process
+CALIBRATION_DATA_CACHE_SIZE = config('CALIBRATION_DATA_CACHE_SIZE', default=1024, cast=int)
+
+# On-disk store of rendered image previews, empty to disable, preview sizes to store, and its size in gigabytes
+PREVIEWS_PATH = config('PREVIEWS_PATH', default=str(BASE_DIR / 'previews'), cast=str)
+PREVIEWS_STORED_SIZES = config('PREVIEWS_STORED_SIZES', default='128,800', cast=Csv(int))
+PREVIEWS_STORE_SIZE = config('PREVIEWS_STORE_SIZE', default=20, cast=float)
+
+# On-disk store of processed frames for downloads, empty to disable, and its size in gigabytes
+PROCESSED_PATH = config('PROCESSED_PATH', default=str(BASE_DIR / 'processed'), cast=str)
+PROCESSED_STORE_SIZE = config('PROCESSED_STORE_SIZE', default=50, cast=float)
+
+# Bulk frames download - maximal number of frames, and worker threads for calibration
+DOWNLOAD_BULK_SIZE = config('DOWNLOAD_BULK_SIZE', default=10000, cast=int)
+DOWNLOAD_JOBS = config('DOWNLOAD_JOBS', default=2, cast=int)
+
+# Load light curves for the interactive plot in compact binary form instead of JSON
+PHOTOMETRY_BINARY_PLOT = config('PHOTOMETRY_BINARY_PLOT', default=False, cast=bool)
+
+# Light curve query results cache, timeout in seconds or 0 to disable
+PHOTOMETRY_CACHE_TIMEOUT = config('PHOTOMETRY_CACHE_TIMEOUT', default=86400, cast=int)
+PHOTOMETRY_CACHE_MAX_POINTS = config('PHOTOMETRY_CACHE_MAX_POINTS', default=1000000, cast=int)
+# How often to check for newly ingested photometry, in seconds
+PHOTOMETRY_CACHE_CHECK_INTERVAL = config('PHOTOMETRY_CACHE_CHECK_INTERVAL', default=300, cast=int)
+
+# Batch cutouts - maximal number of images per request, and worker threads
+CUTOUTS_BATCH_SIZE = config('CUTOUTS_BATCH_SIZE', default=100, cast=int)
+CUTOUTS_JOBS = config('CUTOUTS_JOBS', default=4, cast=int)
+# Maximal number of frames in bulk cutouts download
+CUTOUTS_EXPORT_SIZE = config('CUTOUTS_EXPORT_SIZE', default=5000, cast=int)
+
+# Image lists count the results exactly only up to this number, and use planner estimate above it
+IMAGES_COUNT_LIMIT = config('IMAGES_COUNT_LIMIT', default=10000, cast=int)
+
+# How often, in seconds, to re-read the site summaries maintained by update_summaries command
+SUMMARIES_CHECK_INTERVAL = config('SUMMARIES_CHECK_INTERVAL', default=60, cast=int)
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
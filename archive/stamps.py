@@ -0,0 +1,101 @@
+from django.conf import settings
+
+import posixpath
+
+import numpy as np
+import cv2
+
+from skimage.transform import rescale
+
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from stdpipe import cutouts
+
+from .calibrations import CalibrationPipeline
+from .utils import parallel_map
+from . import previews
+
+
+def make_cutout(image, ra, dec, sr, pipeline=None, region=True):
+    """
+    Calibrated cutout of radius sr degrees around ra, dec, and its header.
+    With region=True, only the needed part of the frame is read and calibrated if possible.
+    """
+    filename = posixpath.join(settings.BASE_DIR, image.filename)
+
+    if pipeline is None:
+        pipeline = CalibrationPipeline(image)
+
+    if region:
+        # Read and calibrate just the region around the position
+        result = pipeline.process_cutout(filename, ra, dec, sr)
+        if result is not None:
+            return result
+
+    # Full calibration of the whole frame
+    data = fits.getdata(filename, -1)
+    header = fits.getheader(filename, -1)
+
+    # Clean up the header from COMMENT and HISTORY keywords that may break things
+    header.remove('COMMENT', remove_all=True, ignore_missing=True)
+    header.remove('HISTORY', remove_all=True, ignore_missing=True)
+
+    data,header = pipeline.apply(data, header)
+
+    wcs = WCS(header)
+    x0,y0 = wcs.all_world2pix(ra, dec, 0)
+    r0 = sr/np.hypot(wcs.pixel_scale_matrix[0,0], wcs.pixel_scale_matrix[0,1])
+
+    return cutouts.crop_image_centered(data, x0, y0, r0, header=header)
+
+
+def resize_cutout(crop, size):
+    """
+    Scale the cutout to a given width, without smoothing when upscaling
+    """
+    if size > crop.shape[1]:
+        return rescale(crop, size/crop.shape[1], mode='reflect', anti_aliasing=False, order=0)
+    else:
+        return rescale(crop, size/crop.shape[1], mode='reflect', anti_aliasing=True)
+
+
+def map_cutouts(func, images, ra, dec, sr, region=True, jobs=None, window=None):
+    """
+    Yield (image, func(image, crop, header)) for cutouts of all images, in the original order,
+    computed in a pool of worker threads. The result is None if the cutout failed.
+
+    Calibration frames are looked up in the calling thread, so that the workers never touch
+    the database. At most `window` images are in flight at any time, so arbitrarily long
+    sequences are processed in constant memory. Images should come ordered by time, so that
+    the consecutive ones from the same night share the cached calibration frames.
+    """
+    def process(image, pipeline):
+        try:
+            crop,header = make_cutout(image, ra, dec, sr, pipeline=pipeline, region=region)
+            return image, func(image, crop, header)
+        except Exception:
+            return image, None
+
+    items = ((image, CalibrationPipeline(image)) for image in images)
+
+    yield from parallel_map(process, items, jobs=jobs or settings.CUTOUTS_JOBS, window=window)
+
+
+def make_sprite(stamps, size, columns=1, background=255):
+    """
+    Tile 8-bit BGR stamps into a grid of size x size cells, row by row.
+    Missing stamps are left blank, larger ones are cropped.
+    """
+    rows = max(1, (len(stamps) + columns - 1)//columns)
+    sprite = np.full((rows*size, columns*size, 3), background, dtype=np.uint8)
+
+    for i,stamp in enumerate(stamps):
+        if stamp is None:
+            continue
+
+        y,x = (i//columns)*size, (i % columns)*size
+        stamp = stamp[:size, :size]
+        sprite[y:y + stamp.shape[0], x:x + stamp.shape[1]] = stamp
+
+    return sprite
@@ -0,0 +1,246 @@
+import os
+import io
+import time
+import tarfile
+import tempfile
+import zipfile
+
+from astropy.io import fits
+
+
+# FITS block size
+FITS_BLOCK = 2880
+
+# Tar block size
+TAR_BLOCK = 512
+
+
+def tar_header(name, size, mtime=None):
+    """
+    Tar header block(s) for a regular file member of a given size
+    """
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(time.time() if mtime is None else mtime)
+    info.mode = 0o644
+
+    return info.tobuf(format=tarfile.PAX_FORMAT)
+
+
+def tar_member(name, size, chunks, mtime=None):
+    """
+    Yield the tar member with contents given as an iterable of byte chunks of a known total size
+    """
+    yield tar_header(name, size, mtime=mtime)
+
+    written = 0
+    for chunk in chunks:
+        written += len(chunk)
+        yield chunk
+
+    if written != size:
+        raise ValueError('Tar member %s has size %d instead of %d' % (name, written, size))
+
+    yield b'\0' * (-size % TAR_BLOCK)
+
+
+def tar_member_size(name, size, mtime=None):
+    """
+    Number of bytes tar_member() will produce for a given member
+    """
+    return len(tar_header(name, size, mtime=mtime)) + size + (-size % TAR_BLOCK)
+
+
+def tar_end():
+    """
+    End-of-archive marker
+    """
+    return b'\0' * (2*TAR_BLOCK)
+
+
+class _Sink:
+    """
+    Write-only non-seekable file collecting the written data for streaming
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_zip(members):
+    """
+    Yield ZIP archive of members given as (name, chunks) tuples, without compression.
+    Member contents are streamed chunk by chunk, with their sizes and checksums
+    written after the data, so they do not have to be known in advance.
+    """
+    sink = _Sink()
+
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for name,chunks in members:
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+
+            with zf.open(info, 'w', force_zip64=True) as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield sink.pop()
+
+            yield sink.pop()
+
+    yield sink.pop()
+
+
+def stream_tar(members):
+    """
+    Yield tar archive of members given as (name, size, chunks) tuples
+    """
+    for name,size,chunks in members:
+        yield from tar_member(name, size, chunks)
+
+    yield tar_end()
+
+
+def read_chunks(filename, chunk_size=1024*1024, offset=0, length=None):
+    """
+    Yield the contents of the file in chunks
+    """
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+
+        while length is None or length > 0:
+            chunk = f.read(chunk_size if length is None else min(chunk_size, length))
+            if not chunk:
+                break
+
+            if length is not None:
+                length -= len(chunk)
+
+            yield chunk
+
+
+def fits_bytes(data, header=None):
+    """
+    Single-HDU FITS file with given data and header
+    """
+    s = io.BytesIO()
+    fits.writeto(s, data, header)
+
+    return s.getvalue()
+
+
+def fits_primary(header=None):
+    """
+    Empty primary HDU starting the multi-extension FITS file
+    """
+    s = io.BytesIO()
+    fits.PrimaryHDU(header=header).writeto(s)
+
+    return s.getvalue()
+
+
+def fits_extension(data, header=None, name=None):
+    """
+    Image extension HDU with given data and header, to be appended to multi-extension FITS file
+    """
+    s = io.BytesIO()
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(data, header=header, name=name)]).writeto(s)
+
+    # Strip the empty primary HDU, which is a single header block
+    return s.getvalue()[FITS_BLOCK:]
+
+
+def fits_stream(data, header=None, chunk_size=1024*1024):
+    """
+    Single-HDU FITS file with given data and header, as its total length and a generator
+    of chunks. Only a chunk of rows is converted to FITS byte order at a time.
+    """
+    if data.dtype.kind not in 'fi':
+        # Unsigned or other data needing scaling, let astropy handle it
+        contents = fits_bytes(data, header)
+        return len(contents), iter([contents])
+
+    hdu = fits.PrimaryHDU(data, header=header)
+
+    head = hdu.header.tostring().encode('ascii')
+    nbytes = data.nbytes
+    padding = -nbytes % FITS_BLOCK
+
+    def chunks():
+        yield head
+
+        rows = max(1, chunk_size // max(1, data[0].nbytes)) if data.ndim > 1 else len(data)
+        dtype = data.dtype.newbyteorder('>')
+
+        for i in range(0, len(data), rows):
+            yield data[i:i + rows].astype(dtype).tobytes()
+
+        yield b'\0' * padding
+
+    return len(head) + nbytes + padding, chunks()
+
+
+def tee_file(chunks, path, callback=None):
+    """
+    Yield the chunks while also writing them to the file. The file is created atomically
+    once all chunks are consumed, then callback() is called. Partial files are removed.
+    """
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+
+    fd,tmpname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+
+        os.replace(tmpname, path)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+    if callback is not None:
+        callback()
+
+
+def prune_directory(path, max_bytes):
+    """
+    Remove the least recently modified files from the directory tree until its total size fits max_bytes
+    """
+    files = []
+
+    for dirpath,dirnames,filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                st = os.stat(os.path.join(dirpath, filename))
+                files.append((st.st_mtime, st.st_size, os.path.join(dirpath, filename)))
+            except FileNotFoundError:
+                pass
+
+    total = sum(_[1] for _ in files)
+
+    for mtime,size,filename in sorted(files):
+        if total <= max_bytes:
+            break
+
+        try:
+            os.unlink(filename)
+            total -= size
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,178 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Sum
+
+import time
+
+from .models import Images, Calibrations, SiteSummary, NightSummary
+from .utils import fast_distinct
+
+
+# Search form fields with their distinct values stored in the summaries
+FACETS = {'type': 'types', 'filter': 'filters', 'ccd': 'ccds', 'serial': 'serials'}
+
+_state = {'checked': 0, 'sites': [], 'facets': {}}
+
+
+def scan_nights(site, since=None):
+    """
+    Per-night rollups of the images and calibrations of the site, from given night onwards
+    """
+    images = Images.objects.filter(site=site, night__isnull=False)
+    calibs = Calibrations.objects.filter(site=site, night__isnull=False)
+
+    if since:
+        images = images.filter(night__gte=since)
+        calibs = calibs.filter(night__gte=since)
+
+    rows = images.values('night', *FACETS.keys()).annotate(
+        count=Count('id'), exposure=Sum('exposure'), last_time=Max('time')
+    ).order_by()
+
+    nights = {}
+
+    for row in rows:
+        night = nights.get(row['night'])
+        if night is None:
+            night = nights[row['night']] = NightSummary(night=row['night'], site=site)
+
+        night.count += row['count']
+        night.exposure += row['exposure'] or 0
+
+        if row['last_time'] is not None and (night.last_time is None or row['last_time'] > night.last_time):
+            night.last_time = row['last_time']
+
+        for field,name in FACETS.items():
+            value = row[field]
+            if value is None:
+                continue
+
+            if field == 'serial':
+                if value not in night.serials:
+                    night.serials.append(value)
+            else:
+                values = getattr(night, name)
+                values[value] = values.get(value, 0) + row['count']
+
+    for row in calibs.values('night', 'type').annotate(count=Count('id')).order_by():
+        if row['night'] in nights and row['type'] is not None:
+            nights[row['night']].calibrations[row['type']] = row['count']
+
+    for night in nights.values():
+        night.serials.sort()
+
+    return sorted(nights.values(), key=lambda _: _.night)
+
+
+def update_site_summary(site, since=None, full=False):
+    """
+    Update the rollups of a single site, re-scanning only the images from its last
+    summarized night onwards, or from `since` night if it is earlier, or all of them
+    with full=True. Then the summary of the site is derived from its nightly rollups.
+    """
+    if not full:
+        last = NightSummary.objects.filter(site=site).aggregate(last=Max('night'))['last']
+        since = min([_ for _ in [since, last] if _], default=None)
+    else:
+        since = None
+
+    nights = scan_nights(site, since=since)
+
+    with transaction.atomic():
+        rollups = NightSummary.objects.filter(site=site)
+        if since:
+            rollups = rollups.filter(night__gte=since)
+        rollups.delete()
+
+        NightSummary.objects.bulk_create(nights)
+
+        summary = SiteSummary(site=site)
+        facets = {field:set() for field in FACETS.keys()}
+
+        for night in NightSummary.objects.filter(site=site).order_by('night'):
+            summary.count += night.count
+
+            summary.first_night = summary.first_night or night.night
+            summary.last_night = night.night
+            summary.last_night_count = night.count
+
+            if night.last_time is not None:
+                summary.last_time = night.last_time
+
+            for field,name in FACETS.items():
+                facets[field].update(getattr(night, name))
+
+        for field,name in FACETS.items():
+            setattr(summary, name, sorted(facets[field]))
+
+        summary.save()
+
+    return summary
+
+
+def update_site_summaries(sites=None, since=None, full=False):
+    """
+    Incrementally update the nightly rollups and summaries of given sites, or of all sites
+    in the archive. Should be run after the ingestion of new images, e.g. by update_summaries
+    command. Use `since` to re-scan older nights, e.g. when new calibrations were produced for them.
+    """
+    prune = sites is None
+
+    if sites is None:
+        fast_distinct.invalidate('images', 'site')
+        sites = [_['site'] for _ in fast_distinct('images', 'site') if _['site'] is not None]
+
+    if full and prune:
+        SiteSummary.objects.exclude(site__in=sites).delete()
+        NightSummary.objects.exclude(site__in=sites).delete()
+
+    summaries = [update_site_summary(site, since=since, full=full) for site in sites]
+
+    _state['checked'] = 0
+
+    return summaries
+
+
+def site_summaries():
+    """
+    All site summaries, kept in memory and re-read at most every SUMMARIES_CHECK_INTERVAL seconds
+    """
+    if time.time() > _state['checked'] + settings.SUMMARIES_CHECK_INTERVAL:
+        sites = list(SiteSummary.objects.all())
+        _state['sites'],_state['facets'] = sites, merge_facets(sites)
+        _state['checked'] = time.time()
+
+    return _state['sites']
+
+
+def merge_facets(sites):
+    """
+    Distinct values of the search fields over all given site summaries
+    """
+    result = {'sites': [{'site': _.site} for _ in sites]}
+
+    for field,name in FACETS.items():
+        values = sorted(set(value for site in sites for value in getattr(site, name)))
+        result[name] = [{field: _} for _ in values]
+
+    return result
+
+
+def facets():
+    """
+    Distinct values of search form fields, as dicts with 'sites', 'types', 'filters',
+    'ccds' and 'serials' lists of {field: value} dicts, as expected by the forms.
+    Falls back to querying the images table if the summaries are not built yet.
+    """
+    sites = site_summaries()
+
+    if not sites:
+        return {
+            'sites': fast_distinct('images', 'site'),
+            'types': fast_distinct('images', 'type'),
+            'filters': fast_distinct('images', 'filter'),
+            'ccds': fast_distinct('images', 'ccd'),
+            'serials': fast_distinct('images', 'serial', 0),
+        }
+
+    return _state['facets']
@@ -33,6 +33,11 @@ def multiply(value, arg):
     return value*arg
 
 
+@register.filter
+def divide(value, arg):
+    return value/arg
+
+
 @register.filter
 def GET_remove(value, key):
     value = value.copy()
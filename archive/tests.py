@@ -0,0 +1,96 @@
+from django.test import SimpleTestCase, RequestFactory, override_settings
+
+import os
+import io
+import csv
+import tarfile
+import tempfile
+import datetime
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+
+
+class FakeImages(list):
+    """
+    List of images mimicking the parts of queryset used by the views
+    """
+
+    def __getitem__(self, key):
+        result = super().__getitem__(key)
+        return FakeImages(result) if isinstance(key, slice) else result
+
+    def order_by(self, *args):
+        return self
+
+    def iterator(self):
+        return iter(self)
+
+
+class FakePipeline:
+    enabled = True
+
+    def __init__(self, image):
+        self.image = image
+
+    def identity(self):
+        return (self.image.id, os.path.getmtime(self.image.filename), ())
+
+    def process(self):
+        return np.full((4, 4), self.image.id, dtype=np.float32), None
+
+
+class ImagesDownloadTest(SimpleTestCase):
+    def test_processed_download_with_missing_frame(self):
+        from . import views_images
+
+        with tempfile.TemporaryDirectory() as path:
+            images = FakeImages()
+            for id in [1, 2, 3]:
+                filename = os.path.join(path, 'frame_%d.fits' % id)
+                open(filename, 'wb').close()
+
+                images.append(SimpleNamespace(
+                    id=id, filename=filename, time=datetime.datetime(2024, 1, 1, 0, id), night='20240101',
+                    site='auger', ccd='C0', serial=1, type='object', filter='R', exposure=60,
+                ))
+
+            os.unlink(images[1].filename)
+
+            request = RequestFactory().get('/images/download', {'processed': 1})
+            request.user = mock.Mock(has_perms=lambda perms: True)
+
+            with override_settings(BASE_DIR=path, PROCESSED_PATH=os.path.join(path, 'processed'), DOWNLOAD_JOBS=2), \
+                 mock.patch.object(views_images, 'get_images_around', return_value=(images, {})), \
+                 mock.patch.object(views_images, 'CalibrationPipeline', FakePipeline):
+                response = views_images.images_download(request)
+                contents = b''.join(response.streaming_content)
+
+        with tarfile.open(fileobj=io.BytesIO(contents)) as tar:
+            names = tar.getnames()
+            manifest = list(csv.DictReader(io.StringIO(tar.extractfile('manifest.csv').read().decode())))
+
+        self.assertEqual(len(names), 3)
+        self.assertEqual([_['status'] for _ in manifest], ['ok', 'missing', 'ok'])
+
+
+class PlotLcTest(SimpleTestCase):
+    def test_missing_errors(self):
+        from .plots import plot_lc
+
+        times = np.datetime64('2024-01-01') + np.arange(10)*np.timedelta64(1, 'h')
+        mags = np.linspace(10, 11, 10)
+
+        lcs = [
+            ('red', times, mags, np.full(10, np.nan)),
+            ('blue', times, mags + 1, np.full(10, 0.1)),
+            ('green', times, np.full(10, np.nan), np.full(10, np.nan)),
+        ]
+
+        for format in ['jpeg', 'png']:
+            buf = plot_lc(lcs, title='test', size=400, format=format)
+            self.assertTrue(buf)
+
+        # Single filter without errors only
+        self.assertTrue(plot_lc(lcs[:1], size=400))
@@ -31,6 +31,8 @@ urlpatterns = [
 
     # Images
     path(r'images/', views_images.images_list, name='images'),
+    path(r'images/download', views_images.images_download, name='images_download'),
+    path(r'images/download/zip', views_images.images_download, {'mode':'zip'}, name='images_download_zip'),
 
     # Nights
     path(r'nights/', views_images.images_nights, name='nights'),
@@ -51,6 +53,10 @@ urlpatterns = [
 
     # Cutouts
     path(r'images/cutouts/', views_images.images_cutouts, name='images_cutouts'),
+    path(r'images/cutouts/batch', views_images.images_cutouts_batch, name='images_cutouts_batch'),
+    path(r'images/cutouts/batch/zip', views_images.images_cutouts_batch, {'mode':'zip'}, name='images_cutouts_batch_zip'),
+    path(r'images/cutouts/download', views_images.images_cutouts_download, name='images_cutouts_download'),
+    path(r'images/cutouts/download/fits', views_images.images_cutouts_download, {'mode':'fits'}, name='images_cutouts_download_fits'),
     path(r'images/<int:id>/cutout', views_images.image_cutout, name='image_cutout'),
     path(r'images/<int:id>/cutout/preview', views_images.image_cutout, {'size':300}, name='image_cutout_preview'),
     path(r'images/<int:id>/cutout/download', views_images.image_cutout, {'mode':'download'}, name='image_cutout_download'),
@@ -59,6 +65,7 @@ urlpatterns = [
     # path(r'photometry/?', views_photometry.photometry, name='photometry'),
     path(r'photometry/lc', views_photometry.lc, {'mode': 'jpeg'}, name='photometry_lc'),
     path(r'photometry/json', views_photometry.lc, {'mode': 'json'}, name='photometry_json'),
+    path(r'photometry/binary', views_photometry.lc, {'mode': 'binary'}, name='photometry_binary'),
     path(r'photometry/text', views_photometry.lc, {'mode': 'text'}, name='photometry_text'),
     path(r'photometry/mjd', views_photometry.lc, {'mode': 'mjd'}, name='photometry_mjd'),
 
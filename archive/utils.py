@@ -1,5 +1,7 @@
 from django.db import connections, transaction
 from django.shortcuts import redirect
+from django.http import QueryDict
+from django.utils.cache import patch_response_headers
 
 from urllib.parse import urlencode
 
@@ -7,70 +9,323 @@ import functools
 from django.core.cache import cache
 import hashlib
 import pickle
+import threading
+import time
+import traceback
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 _MISSING = object()
 
+# Argument types for which repr() is a faithful and cheap cache key
+_SCALARS = (str, int, float, bool, bytes, type(None))
 
-def memoize(timeout=600, make_key=None):
+
+def _is_scalar(value):
+    return type(value) in _SCALARS or (type(value) is tuple and all(_is_scalar(_) for _ in value))
+
+
+def make_args_key(args, kwargs):
+    """
+    Hash of the function arguments. Scalar ones are hashed by their repr(),
+    anything else is pickled
+    """
+    if all(_is_scalar(_) for _ in args) and all(_is_scalar(_) for _ in kwargs.values()):
+        data = repr((args, sorted(kwargs.items()))).encode()
+    else:
+        data = pickle.dumps((args, kwargs))
+
+    return hashlib.md5(data).hexdigest()
+
+
+class KeyLocks:
+    """
+    Per-key locks, created on demand and dropped once nobody holds or waits for them
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = {}
+
+    @contextmanager
+    def __call__(self, key):
+        with self.lock:
+            lock,count = self.locks.get(key, (None, 0))
+            if lock is None:
+                lock = threading.Lock()
+            self.locks[key] = (lock, count + 1)
+
+        try:
+            with lock:
+                yield
+        finally:
+            with self.lock:
+                lock,count = self.locks[key]
+                if count > 1:
+                    self.locks[key] = (lock, count - 1)
+                else:
+                    del self.locks[key]
+
+
+_key_locks = KeyLocks()
+
+
+def single_flight(key, compute, lookup, lock_timeout=60):
+    """
+    Result of compute() for the cache key, computed only once for concurrent callers - within
+    the process by a per-key lock, and across the processes sharing the cache by a short-lived
+    lease entry. `lookup` should return the result already stored by another caller, or None.
+    """
+    with _key_locks(key):
+        # Maybe it has been computed while we were waiting for the lock
+        result = lookup()
+        if result is not None:
+            return result
+
+        lease = key + ':lease'
+
+        if not cache.add(lease, 1, lock_timeout):
+            # Another process computes it, wait for its result
+            deadline = time.time() + lock_timeout
+            while time.time() < deadline:
+                time.sleep(0.05)
+
+                result = lookup()
+                if result is not None:
+                    return result
+
+                if cache.get(lease) is None:
+                    break
+
+            cache.add(lease, 1, lock_timeout)
+
+        try:
+            return compute()
+        finally:
+            cache.delete(lease)
+
+
+def memoize(timeout=600, stale=0, make_key=None, lock_timeout=60):
+    """
+    Cache the results of the function for `timeout` seconds.
+
+    Concurrent misses of the same key are computed only once - within the process by a
+    per-key lock, and across the processes sharing the cache by a short-lived lease entry.
+    With `stale` > 0, results up to that many seconds past their timeout are still returned
+    immediately while a single background thread recomputes them.
+
+    Results, including None, are stored wrapped so that they are never confused with a miss.
+    Exceptions are not cached. Hit, stale and miss counters are returned by func.cache_info(),
+    and func.invalidate(*args, **kwargs) drops the cached result.
+    """
     def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
+        prefix = f"{func.__module__}.{func.__qualname__}"
+        stats = {'hits': 0, 'stale': 0, 'misses': 0}
+        refreshing = set()
+
+        def get_key(args, kwargs):
             if make_key:
-                key = make_key(*args, **kwargs)
+                return make_key(*args, **kwargs)
             else:
-                key_data = (func.__module__, func.__qualname__, args, kwargs)
-                key_prefix = f"{func.__module__}.{func.__qualname__}"
-                key = f"{key_prefix}:{hashlib.md5(pickle.dumps(key_data)).hexdigest()}"
+                return f"{prefix}:{make_args_key(args, kwargs)}"
+
+        def compute(key, args, kwargs):
+            entry = (func(*args, **kwargs), time.time() + timeout)
+            cache.set(key, entry, timeout + stale)
+            return entry
+
+        def refresh(key, args, kwargs):
+            try:
+                if cache.add(key + ':lease', 1, lock_timeout):
+                    try:
+                        compute(key, args, kwargs)
+                    finally:
+                        cache.delete(key + ':lease')
+            except Exception:
+                traceback.print_exc()
+            finally:
+                refreshing.discard(key)
+                connections.close_all()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = get_key(args, kwargs)
+
+            entry = cache.get(key)
+            if entry is not None:
+                result,expires = entry
+
+                if time.time() < expires:
+                    stats['hits'] += 1
+                elif key not in refreshing:
+                    stats['stale'] += 1
+                    refreshing.add(key)
+                    threading.Thread(target=refresh, args=(key, args, kwargs), daemon=True).start()
+                else:
+                    stats['stale'] += 1
 
-            result = cache.get(key, _MISSING)
-            if result is not _MISSING:
                 return result
 
-            result = func(*args, **kwargs)
-            cache.set(key, result, timeout)
-            return result
+            stats['misses'] += 1
+
+            entry = single_flight(key, lambda: compute(key, args, kwargs), lambda: cache.get(key), lock_timeout)
+
+            return entry[0]
+
+        wrapper.cache_info = lambda: dict(stats)
+        wrapper.invalidate = lambda *args, **kwargs: cache.delete(get_key(args, kwargs))
 
         return wrapper
     return decorator
 
 
-#@transaction.commit_on_success
-@memoize(timeout=600)
-def db_query(string, params, db='fram', debug=False, simplify=True):
-    connection = connections[db]
+def db_fetch(string, params, db='fram', simplify=True):
+    """
+    Execute the query and return its rows as a list of dicts, or None if it returns no data.
+    With simplify=True, single row is returned as a dict, and single value as is.
+    """
+    with connections[db].cursor() as cursor:
+        cursor.execute(string, params)
+
+        if cursor.description is None:
+            # No data returned
+            return None
+
+        columns = [col[0] for col in cursor.description]
+        result = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    if simplify and len(result) == 1:
+        if len(result[0]) == 1:
+            result = list(result[0].values())[0]
+        else:
+            result = result[0]
+
+    return result
 
-    cursor = connection.cursor()
-    result = None
 
-    print('db_query')
+@memoize(timeout=600)
+def _db_query(string, params, db, simplify):
+    return db_fetch(string, params, db=db, simplify=simplify)
+
 
+#@transaction.commit_on_success
+def db_query(string, params, db='fram', debug=False, simplify=True):
+    """
+    Cached db_fetch(). Errors are printed and give None, which is not cached
+    """
     if debug:
-        print(cursor.mogrify(string, params))
+        with connections[db].cursor() as cursor:
+            print(cursor.mogrify(string, params))
 
     try:
-        cursor.execute(string, params)
-        try:
-            columns = [col[0] for col in cursor.description]
-            result = [dict(zip(columns, row)) for row in cursor.fetchall()]
-
-            if simplify and len(result) == 1:
-                if len(result[0]) == 1:
-                    result = result[0][0]
-                else:
-                    result = result[0]
-        except:
-            # No data returned
-            result = None
+        return _db_query(string, params, db, simplify)
     except:
-        import traceback
         traceback.print_exc()
-        pass
-    finally:
-        cursor.close()
+        return None
+
+
+@memoize(timeout=3600, stale=86400)
+def fast_distinct(table, column, *args):
+    """
+    Distinct values of the column in the table, as a list of dicts,
+    using fast_distinct() SQL function
+    """
+    string = "select fast_distinct(%s, %s" + ", %s"*len(args) + ") as " + column
+
+    return db_fetch(string, (table, column) + args, simplify=False)
+
+
+def normalize_query(query, rounding={}):
+    """
+    Immutable copy of the query dict with parameters sorted by name, and the values
+    of numeric ones rounded to the number of decimals given in `rounding`
+    """
+    result = QueryDict(mutable=True)
+
+    for key in sorted(query.keys()):
+        values = query.getlist(key)
+
+        if key in rounding:
+            try:
+                values = [repr(round(float(_), rounding[key])) for _ in values]
+            except ValueError:
+                pass
+
+        result.setlist(key, values)
+
+    result._mutable = False
 
     return result
 
 
+def cache_view(timeout=3600, rounding={}):
+    """
+    Cache the responses of the view, like cache_page, but keyed on the view arguments
+    and normalized query parameters, see normalize_query(), so that trivially different
+    URLs share the cache entry. The view gets the normalized parameters too.
+    Place it below permission checks, so that cached responses are not served without them.
+    """
+    def decorator(view):
+        prefix = f"view:{view.__module__}.{view.__qualname__}"
+
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+
+            request.GET = normalize_query(request.GET, rounding)
+
+            key_data = (args, sorted(kwargs.items()), request.GET.urlencode())
+            key = f"{prefix}:{hashlib.md5(repr(key_data).encode()).hexdigest()}"
+
+            entry = cache.get(key)
+
+            if entry is not None:
+                response,expires = entry
+
+                # Client caching headers for the remaining lifetime of the entry
+                del response['Expires']
+                patch_response_headers(response, max(0, int(expires - time.time())))
+            else:
+                response = view(request, *args, **kwargs)
+
+                if response.status_code == 200 and not response.streaming:
+                    patch_response_headers(response, timeout)
+                    expires = time.time() + timeout
+
+                    if hasattr(response, 'render') and callable(response.render):
+                        response.add_post_render_callback(lambda r: cache.set(key, (r, expires), timeout))
+                    else:
+                        cache.set(key, (response, expires), timeout)
+
+            return response
+
+        return wrapper
+    return decorator
+
+
+def parallel_map(func, items, jobs=4, window=None):
+    """
+    Yield func(*item) for all items, in their original order, computed in a pool
+    of worker threads. Items are consumed lazily in the calling thread, with at most
+    `window` of them in flight, so arbitrarily long sequences use constant memory.
+    """
+    window = window or 2*jobs
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+
+        for item in items:
+            pending.append(executor.submit(func, *item))
+
+            if len(pending) >= window:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
 def redirect_get(url_or_view, *args, **kwargs):
     get_params = kwargs.pop('get', None)
 
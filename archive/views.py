@@ -10,19 +10,29 @@ from urllib.parse import urlencode
 from django.contrib import messages
 
 from .models import Images
-from .utils import redirect_get, db_query
+from .utils import redirect_get, db_fetch, memoize
 
 # FRAM modules
 from fram.resolve import resolve
 
 from . import forms
+from . import summaries
+
+
+@memoize(timeout=600, stale=86400)
+def site_summary():
+    """
+    Number of images and first/last nights for every site, directly from the images table
+    """
+    return db_fetch('select site,count(*),(select night from images where site=i.site order by time desc limit 1) as last_night, (select night from images where site=i.site order by time asc limit 1) as first_night from images i group by i.site order by i.site;', (), simplify=False)
 
 
 # @cache_page(3600)
 def index(request):
     context = {}
 
-    sites = db_query('select site,count(*),(select night from images where site=i.site order by time desc limit 1) as last, (select night from images where site=i.site order by time asc limit 1) as first from images i group by i.site order by i.site;', (), simplify=False)
+    # Maintained summaries, or the slow query until they are built
+    sites = summaries.site_summaries() or site_summary()
 
     context['sites'] = sites
 
@@ -33,23 +43,13 @@ def index(request):
 def search(request, mode='images'):
     context = {}
 
-    # Possible values for fields
-    # TODO: properly cache these values
-
-    # types = Images.objects.distinct('type').values('type')
-    types = db_query("select fast_distinct(%s, %s) as type", ('images', 'type'))
-
-    # sites = Images.objects.distinct('site').values('site')
-    sites = db_query("select fast_distinct(%s, %s) as site", ('images', 'site'))
-
-    # ccds = Images.objects.distinct('ccd').values('ccd')
-    ccds = db_query("select fast_distinct(%s, %s) as ccd", ('images', 'ccd'))
-
-    # serials = Images.objects.distinct('serial').values('serial')
-    serials = db_query("select fast_distinct(%s, %s, 0) as serial", ('images', 'serial'))
-
-    # filters = Images.objects.distinct('filter').values('filter')
-    filters = db_query("select fast_distinct(%s, %s) as filter", ('images', 'filter'))
+    # Possible values for fields, from the maintained summaries
+    facets = summaries.facets()
+    types = facets['types']
+    sites = facets['sites']
+    ccds = facets['ccds']
+    serials = facets['serials']
+    filters = facets['filters']
 
     form = forms.ImagesSearchForm(
         request.POST or None,
@@ -107,6 +107,7 @@ def search(request, mode='images'):
 
                     context['lc'] = reverse('photometry_lc') + '?' + urlencode(params)
                     context['lc_json'] = reverse('photometry_json') + '?' + urlencode(params)
+                    context['lc_binary'] = reverse('photometry_binary') + '?' + urlencode(params)
                     context['lc_text'] = reverse('photometry_text') + '?' + urlencode(params)
                     context['lc_mjd'] = reverse('photometry_mjd') + '?' + urlencode(params)
 
@@ -1,34 +1,40 @@
-from django.http import HttpResponse, FileResponse
+from django.http import HttpResponse, HttpResponseBadRequest, FileResponse, StreamingHttpResponse
 from django.template.response import TemplateResponse
 from django.shortcuts import redirect
 from django.views.decorators.cache import cache_page
 from django.views.decorators.csrf import csrf_protect
 from django.contrib.auth.decorators import permission_required
+from django.contrib import messages
 from django.conf import settings
 
 from django.db.models import Count
 
 import os, sys, posixpath
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-from matplotlib.figure import Figure
-from matplotlib import colormaps
 import numpy as np
 
-import cv2
-
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
-from skimage.transform import rescale
-from io import BytesIO
+from io import BytesIO, StringIO
+import csv
+import hashlib
+import zipfile
+import cv2
 
 from astropy.io import fits
 from astropy.wcs import WCS
 
 from esutil import htm
 
-from .models import Images, Calibrations
-from .utils import db_query
+from .models import Images, Calibrations, NightSummary
+from .utils import parallel_map, cache_view
+from .calibrations import CalibrationPipeline, processed_path, MASTER_TYPES
+from . import previews
+from . import plots
+from . import stamps
+from . import streams
+from . import paging
+from . import summaries
 
 # FRAM modules
 from fram import calibrate
@@ -37,35 +43,8 @@ from fram import utils
 from fram.fram import Fram, parse_iso_time, get_night
 
 
-# TODO: memoize the result
-def find_calibration_image(image, type='masterdark', night=None, site=None, ccd=None, serial=None, exposure=None, cropped_width=None, cropped_height=None, filter=None, binning=None):
-    calibs = Calibrations.objects.all()
-
-    calibs = calibs.filter(type=type)
-
-    calibs = calibs.filter(site=image.site)
-    calibs = calibs.filter(ccd=image.ccd)
-    calibs = calibs.filter(serial=image.serial)
-
-    if type not in ['bias', 'dcurrent', 'masterflat']:
-        calibs = calibs.filter(exposure=image.exposure)
-
-    calibs = calibs.filter(cropped_width=image.cropped_width)
-    calibs = calibs.filter(cropped_height=image.cropped_height)
-    calibs = calibs.filter(binning=image.binning)
-
-    if type in ['masterflat']:
-        calibs = calibs.filter(filter=image.filter)
-
-#    print(type, image.site, image.ccd, image.serial, image.binning, image.keywords['NAXIS1'], image.keywords['NAXIS2'], image.filter, image.exposure)
-
-    calibs1 = calibs.filter(night__lte=image.night).order_by('-night')
-    if calibs1.first():
-        return calibs1.first()
-    else:
-        # No frames earlier than the date, let's look for a later one!
-        calibs1 = calibs.filter(night__gte=image.night).order_by('night')
-        return calibs1.first()
+# Maximal width or height of JPEG image
+JPEG_MAX_SIZE = 65500
 
 
 def get_images(request):
@@ -126,68 +105,83 @@ def get_images(request):
     return images
 
 
-@permission_required('auth.can_view_images', raise_exception=True)
-def images_list(request):
-    context = {}
-
+def get_images_around(request):
+    """
+    Images matching the request, with centers within the search radius if the position is given
+    """
     images = get_images(request)
+    params = {}
 
     if request.GET.get('ra') and request.GET.get('dec'):
-        ra = float(request.GET.get('ra'))
-        dec = float(request.GET.get('dec'))
-        sr = float(request.GET.get('sr', 0))
-        context['ra'] = ra
-        context['dec'] = dec
-        context['sr'] = sr
+        params['ra'] = float(request.GET.get('ra'))
+        params['dec'] = float(request.GET.get('dec'))
+        params['sr'] = float(request.GET.get('sr', 0))
 
         # Images with centers within given search radius
-        images = images.extra(where=["q3c_radial_query(ra, dec, %s, %s, %s)"], params=(ra, dec, sr))
+        images = images.extra(where=["q3c_radial_query(ra, dec, %s, %s, %s)"], params=(params['ra'], params['dec'], params['sr']))
+
+    return images, params
+
+
+def images_page(request, images, context, template_name, rows_template_name, size, sort_fields=paging.SORT_FIELDS):
+    """
+    Render the list of images - streamed in single-page mode, paginated by (time, id)
+    keyset in default ordering, or by offset otherwise
+    """
+    order,message = paging.plan_sort(request.GET.get('sort'), small=context['count_exact'], fields=sort_fields)
+    if message:
+        messages.warning(request, message)
+
+    keyset = order == paging.DEFAULT_SORT
+    images = images.order_by(*order)
+
+    if request.GET.get('singlepage'):
+        rows = images.iterator(chunk_size=1000)
+        return StreamingHttpResponse(
+            paging.stream_template(request, template_name, context, rows_template_name, rows),
+            content_type='text/html; charset=utf-8'
+        )
+
+    if keyset:
+        page = paging.keyset_page(images, size, after=request.GET.get('after'), before=request.GET.get('before'))
+        context['page'] = page
+        context['images'] = page.items
+    else:
+        context['images'] = images
 
-    # Possible values for fields
-    # types = images.distinct('type').values('type')
-    types = db_query("select fast_distinct(%s, %s) as type", ('images', 'type'))
-    context['types'] = types
+    return TemplateResponse(request, template_name, context=context)
 
-    # sites = images.distinct('site').values('site')
-    sites = db_query("select fast_distinct(%s, %s) as site", ('images', 'site'))
-    context['sites'] = sites
 
-    # ccds = images.distinct('ccd').values('ccd')
-    ccds = db_query("select fast_distinct(%s, %s) as ccd", ('images', 'ccd'))
-    filters = db_query("select fast_distinct(%s, %s) as filter", ('images', 'filter'))
-    context['ccds'] = ccds
+@permission_required('auth.can_view_images', raise_exception=True)
+def images_list(request):
+    context = {}
 
-    # filters = images.distinct('filter').values('filter')
-    context['filters'] = filters
+    images,params = get_images_around(request)
+    context.update(params)
 
-    sort = request.GET.get('sort')
-    if sort:
-        images = images.order_by(*(sort.split(',')))
-    else:
-        images = images.order_by('-time')
+    # Possible values for fields, from the maintained summaries
+    facets = summaries.facets()
+    for _ in ['types', 'sites', 'ccds', 'filters']:
+        context[_] = facets[_]
 
-    context['images'] = images
+    context['count'],context['count_exact'] = paging.fast_count(images, settings.IMAGES_COUNT_LIMIT)
 
-    if images.count() == 1:
+    if context['count'] == 1:
         return redirect('image_details', id=images.first().id)
 
-    return TemplateResponse(request, 'images.html', context=context)
+    return images_page(request, images, context, 'images.html', 'images_rows.html', 10)
 
 
-@permission_required('auth.can_view_images', raise_exception=True)
-def images_cutouts(request):
-    context = {}
-
+def get_cutout_images(request):
+    """
+    Images containing the requested point, and the parameters of the cutouts
+    """
     images = get_images(request)
 
     ra = float(request.GET.get('ra', 0))
     dec = float(request.GET.get('dec', 0))
     sr = float(request.GET.get('sr', 0.1))
     maxdist = float(request.GET.get('maxdist', 0.0))
-    context['ra'] = ra
-    context['dec'] = dec
-    context['sr'] = sr
-    context['maxdist'] = maxdist
 
     # Images containing given point
     images = images.extra(where=["q3c_radial_query(ra, dec, %s, %s, radius)"], params=(ra, dec))
@@ -197,28 +191,24 @@ def images_cutouts(request):
     if maxdist > 0:
         images = images.extra(where=["q3c_dist(ra, dec, %s, %s) < %s"], params=(ra, dec, maxdist))
 
-    # Possible values for fields
-    # sites = images.distinct('site').values('site')
-    sites = db_query("select fast_distinct(%s, %s) as site", ('images', 'site'))
-    context['sites'] = sites
+    return images, {'ra': ra, 'dec': dec, 'sr': sr, 'maxdist': maxdist}
+
 
-    # ccds = images.distinct('ccd').values('ccd')
-    ccds = db_query("select fast_distinct(%s, %s) as ccd", ('images', 'ccd'))
-    context['ccds'] = ccds
+@permission_required('auth.can_view_images', raise_exception=True)
+def images_cutouts(request):
+    context = {}
 
-    # filters = images.distinct('filter').values('filter')
-    filters = db_query("select fast_distinct(%s, %s) as filter", ('images', 'filter'))
-    context['filters'] = filters
+    images,params = get_cutout_images(request)
+    context.update(params)
 
-    sort = request.GET.get('sort')
-    if sort:
-        images = images.order_by(*(sort.split(',')))
-    else:
-        images = images.order_by('-time')
+    # Possible values for fields, from the maintained summaries
+    facets = summaries.facets()
+    for _ in ['sites', 'ccds', 'filters']:
+        context[_] = facets[_]
 
-    context['images'] = images
+    context['count'],context['count_exact'] = paging.fast_count(images, settings.IMAGES_COUNT_LIMIT)
 
-    return TemplateResponse(request, 'images_cutouts.html', context=context)
+    return images_page(request, images, context, 'images_cutouts.html', 'images_cutouts_rows.html', 20, sort_fields=paging.SORT_FIELDS + ['dist'])
 
 
 @permission_required('auth.can_view_images', raise_exception=True)
@@ -229,15 +219,11 @@ def image_details(request, id=0):
     context['image'] = image
 
     # Calibrations
-    if image.type not in ['masterdark', 'masterflat', 'bias', 'dcurrent', 'dark', 'zero']:
-        context['dark'] = find_calibration_image(image, 'masterdark')
-
-        if context['dark'] is None:
-            context['bias'] = find_calibration_image(image, 'bias')
-            context['dcurrent'] = find_calibration_image(image, 'dcurrent')
-
-        if image.type not in ['flat']:
-            context['flat'] = find_calibration_image(image, 'masterflat')
+    pipeline = CalibrationPipeline(image)
+    context['dark'] = pipeline.cdark
+    context['bias'] = pipeline.cbias
+    context['dcurrent'] = pipeline.cdc
+    context['flat'] = pipeline.cflat
 
     try:
         # Try to read original FITS keywords with comments
@@ -256,86 +242,49 @@ def image_details(request, id=0):
 
 
 def image_response(data, qq=[2.5, 99.75], cmap='Blues_r', quality=75):
-    limits = np.percentile(data[np.isfinite(data)], qq)
-
-    data = (data - limits[0]) / (limits[1] - limits[0])
-    data = np.clip(data, 0.0, 1.0)
-
-    cmap = colormaps[cmap]
-    data = cmap(data) # RGBA
-
-    data = (255 * data).astype(np.uint8)
-
-    # OpenCV expects BGRA
-    data = cv2.cvtColor(data, cv2.COLOR_RGBA2BGRA)
-
-    success, buf = cv2.imencode(
-        ".jpg",
-        data,
-        [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
-    )
-    if not success:
+    buf = previews.render_jpeg(data, qq=qq, cmap=cmap, quality=quality)
+    if buf is None:
         return HttpResponse(status=500)
 
     return HttpResponse(
-        buf.tobytes(),
+        buf,
         content_type="image/jpeg"
     )
 
 
-@cache_page(3600)
 @permission_required('auth.can_view_images', raise_exception=True)
+@cache_view(3600, rounding={'qq': 3})
 def image_preview(request, id=0, size=0):
     image = Images.objects.get(id=id)
-    filename = image.filename
-    filename = posixpath.join(settings.BASE_DIR, filename)
-
-    data = fits.getdata(filename, -1)
-    header = fits.getheader(filename, -1)
 
     if 'size' in request.GET:
         size = int(request.GET.get('size', 0))
 
-    if not 'raw' in request.GET:
-        if image.type not in ['masterdark', 'masterflat', 'bias', 'dcurrent']:
-            dark = None
-
-            if image.type not in ['dark', 'zero']:
-                cdark = find_calibration_image(image, 'masterdark')
-                if cdark is not None:
-                    dark = fits.getdata(cdark.filename, -1)
-                else:
-                    cbias,cdc = find_calibration_image(image, 'bias'), find_calibration_image(image, 'dcurrent')
-                    if cbias is not None and cdc is not None:
-                        bias = fits.getdata(cbias.filename, -1)
-                        dc = fits.getdata(cdc.filename, -1)
-
-                        dark = bias + image.exposure*dc
-
-            if dark is not None:
-                data,header = calibrate.calibrate(data, header, dark=dark) # Subtract dark and linearize
-
-                if image.type not in ['flat1']:
-                    cflat = find_calibration_image(image, 'masterflat')
-                    if cflat is not None:
-                        flat = fits.getdata(cflat.filename, -1)
-                        data *= np.median(flat)/flat
-            else:
-                data,header = calibrate.crop_overscans(data, header)
-    else:
-        data,header = calibrate.crop_overscans(data, header, subtract=False)
+    resample = request.GET.get('resample', 'area')
+    if resample not in previews.RESAMPLE_METHODS:
+        resample = 'area'
 
-    if size:
-        data = rescale(data, size/data.shape[1], mode='reflect', anti_aliasing=True, preserve_range=True)
+    stretch = request.GET.get('stretch', 'sample')
+    if stretch not in previews.STRETCH_METHODS:
+        stretch = 'sample'
 
-    response = image_response(
-        data,
+    buf = previews.get_preview(
+        image,
+        size=size,
         qq=[2.5, float(request.GET.get('qq', 99.75))],
         cmap=request.GET.get('cmap', 'Blues_r'),
-        quality=int(request.GET.get('quality', 75))
+        quality=int(request.GET.get('quality', 75)),
+        raw='raw' in request.GET,
+        resample=resample,
+        stretch=stretch
     )
+    if buf is None:
+        return HttpResponse(status=500)
 
-    return response
+    return HttpResponse(
+        buf,
+        content_type="image/jpeg"
+    )
 
 
 @permission_required('auth.can_view_images', raise_exception=True)
@@ -351,107 +300,202 @@ def image_download(request, id, raw=True):
         response['Content-Length'] = os.path.getsize(filename)
         return response
     else:
-        data = fits.getdata(filename, -1).astype(np.double)
-        header = fits.getheader(filename, -1)
+        pipeline = CalibrationPipeline(image)
+        path = processed_path(pipeline) if settings.PROCESSED_PATH else None
 
-        if image.type not in ['masterdark', 'masterflat', 'dcurrent', 'bias']:
-            dark = None
-
-            if image.type not in ['dark', 'zero']:
-                cdark = find_calibration_image(image, 'masterdark')
-                if cdark is not None:
-                    dark = fits.getdata(cdark.filename, -1)
-                else:
-                    cbias,cdc = find_calibration_image(image, 'bias'), find_calibration_image(image, 'dcurrent')
-                    if cbias is not None and cdc is not None:
-                        bias = fits.getdata(cbias.filename, -1)
-                        dc = fits.getdata(cdc.filename, -1)
-
-                        dark = bias + image.exposure*dc
-
-            if dark is not None:
-                data,header = calibrate.calibrate(data, header, dark=dark) # Subtract dark and linearize
-
-                if image.type not in ['flat']:
-                    cflat = find_calibration_image(image, 'masterflat')
-                    if cflat is not None:
-                        flat = fits.getdata(cflat.filename, -1)
-                        data *= np.median(flat)/flat
-            else:
-                data,header = calibrate.crop_overscans(data, header)
+        response = None
 
-        s = BytesIO()
-        fits.writeto(s, data, header)
+        if path:
+            try:
+                # Previously processed file from the store
+                f = open(path, "rb")
+                os.utime(f.fileno()) # Mark as recently used
+
+                response = FileResponse(f, content_type='application/octet-stream')
+                response['Content-Length'] = os.fstat(f.fileno()).st_size
+            except FileNotFoundError:
+                pass
+
+        if response is None:
+            data,header = pipeline.process(filename)
+            length,chunks = streams.fits_stream(data, header)
+
+            if path:
+                chunks = streams.tee_file(chunks, path, callback=lambda: streams.prune_directory(settings.PROCESSED_PATH, settings.PROCESSED_STORE_SIZE*1024**3))
+
+            response = StreamingHttpResponse(chunks, content_type='application/octet-stream')
+            response['Content-Length'] = length
 
-        response = HttpResponse(s.getvalue(), content_type='application/octet-stream')
         response['Content-Disposition'] = 'attachment; filename=' + os.path.split(filename)[-1] + '.processed.fits'
-        response['Content-Length'] = len(s.getvalue())
         return response
 
 
-@cache_page(3600)
+@permission_required('auth.can_view_images', raise_exception=True)
+def images_download(request, mode='tar'):
+    """
+    All frames matching the images list query, streamed from disk as a tar or ZIP archive
+    with their original relative paths, and a manifest with their checksums at the end.
+    With processed=1, science frames are calibrated in a pool of worker threads.
+    """
+    images,params = get_images_around(request)
+    images = images.order_by('time')[:settings.DOWNLOAD_BULK_SIZE]
+
+    processed = bool(request.GET.get('processed'))
+
+    night = request.GET.get('night')
+    name = 'fram_%s' % (night if night and night != 'all' else 'images')
+    if processed:
+        name += '_processed'
+
+    def process(image, pipeline):
+        """
+        Returns the path of the file to send, or its contents
+        """
+        filename = posixpath.join(settings.BASE_DIR, image.filename)
+
+        if pipeline is None or not pipeline.enabled:
+            return image, filename, None
+
+        try:
+            path = processed_path(pipeline) if settings.PROCESSED_PATH else None
+            if path and os.path.exists(path):
+                return image, path, None
+
+            data,header = pipeline.process()
+            length,chunks = streams.fits_stream(data, header)
+
+            return image, None, b''.join(chunks)
+        except Exception:
+            if not os.path.exists(filename):
+                # Will be marked as missing
+                return image, filename, None
+
+            return image, None, None
+
+    def hashed(chunks, digest):
+        for chunk in chunks:
+            digest.update(chunk)
+            yield chunk
+
+    def members():
+        manifest = StringIO()
+        writer = csv.writer(manifest)
+        writer.writerow(['id', 'time', 'night', 'site', 'ccd', 'serial', 'type', 'filter', 'exposure', 'filename', 'size', 'md5', 'status'])
+
+        if processed:
+            items = ((image, CalibrationPipeline(image)) for image in images.iterator())
+            results = parallel_map(process, items, jobs=settings.DOWNLOAD_JOBS)
+        else:
+            results = (process(image, None) for image in images.iterator())
+
+        for image,path,contents in results:
+            arcname = image.filename.lstrip('/')
+            if processed and image.type not in MASTER_TYPES:
+                arcname += '.processed.fits'
+
+            size,md5,status = None, None, 'ok'
+
+            if path is not None:
+                try:
+                    size = os.path.getsize(path)
+                    chunks = streams.read_chunks(path, length=size)
+                except FileNotFoundError:
+                    status = 'missing'
+            elif contents is not None:
+                size = len(contents)
+                chunks = [contents]
+            else:
+                status = 'failed'
+
+            if status == 'ok':
+                digest = hashlib.md5()
+                yield arcname, size, hashed(chunks, digest)
+                md5 = digest.hexdigest()
+
+            writer.writerow([image.id, image.time, image.night, image.site, image.ccd, image.serial, image.type, image.filter, image.exposure, arcname, size, md5, status])
+
+        contents = manifest.getvalue().encode()
+        yield 'manifest.csv', len(contents), [contents]
+
+    if mode == 'zip':
+        response = StreamingHttpResponse(streams.stream_zip((_[0], _[2]) for _ in members()), content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename=%s.zip' % name
+    else:
+        response = StreamingHttpResponse(streams.stream_tar(members()), content_type='application/x-tar')
+        response['Content-Disposition'] = 'attachment; filename=%s.tar' % name
+
+    return response
+
+
 @permission_required('auth.can_view_images', raise_exception=True)
 def images_nights(request):
-    # nights = Images.objects.order_by('-night').values('night').annotate(count=Count('night'))
-    nights = Images.objects.values('night','site').annotate(count=Count('id')).order_by('-night','site')
+    context = {}
+
+    # Per-night rollups, or aggregation over the images table until they are built
+    nights = NightSummary.objects.all()
+    if nights.exists():
+        context['detailed'] = True
+    else:
+        nights = Images.objects.values('night','site').annotate(count=Count('id')).order_by('-night','site')
 
     site = request.GET.get('site')
     if site and site != 'all':
         nights = nights.filter(site=site)
 
-    context = {'nights':nights}
+    # Date range, nights are strings starting with the year
+    year = request.GET.get('year')
+    if year and year.isdigit():
+        nights = nights.filter(night__gte=year, night__lt=str(int(year) + 1))
+
+    night1 = request.GET.get('night1')
+    if night1:
+        nights = nights.filter(night__gte=night1)
+
+    night2 = request.GET.get('night2')
+    if night2:
+        nights = nights.filter(night__lte=night2)
 
-    sites = Images.objects.distinct('site').values('site')
-    context['sites'] = sites
+    context['nights'] = nights
+
+    context['sites'] = summaries.facets()['sites']
+
+    # Years covered by the archive, for paging
+    years = set()
+    for summary in summaries.site_summaries():
+        years.update(int(_[:4]) for _ in [summary.first_night, summary.last_night] if _ and _[:4].isdigit())
+
+    if years:
+        context['years'] = list(range(max(years), min(years) - 1, -1))
 
     return TemplateResponse(request, 'nights.html', context=context)
 
 
-@cache_page(3600)
 @permission_required('auth.can_analyze_images', raise_exception=True)
+@cache_view(3600, rounding={'aper': 2})
 def image_analysis(request, id=0, mode='fwhm'):
     image = Images.objects.get(id=id)
     filename = image.filename
     filename = posixpath.join(settings.BASE_DIR, filename)
 
-    data = fits.getdata(filename, -1).astype(np.double)
+    data = fits.getdata(filename, -1)
     header = fits.getheader(filename, -1)
 
-    dark = None
-    flat = None
-
     # Clean up the header from COMMENT and HISTORY keywords that may break things
     header.remove('COMMENT', remove_all=True, ignore_missing=True)
     header.remove('HISTORY', remove_all=True, ignore_missing=True)
 
-    if image.type not in ['masterdark', 'masterflat', 'dcurrent', 'bias']:
-        if image.type not in ['dark', 'zero']:
-            cdark = find_calibration_image(image, 'masterdark')
-            if cdark is not None:
-                dark = fits.getdata(cdark.filename, -1)
-            else:
-                cbias,cdc = find_calibration_image(image, 'bias'), find_calibration_image(image, 'dcurrent')
-                if cbias is not None and cdc is not None:
-                    bias = fits.getdata(cbias.filename, -1)
-                    dc = fits.getdata(cdc.filename, -1)
-
-                    dark = bias + image.exposure*dc
+    pipeline = CalibrationPipeline(image)
+    data,header = pipeline.apply(data, header)
+    dark = pipeline.dark
 
-        if dark is not None:
-            data,header = calibrate.calibrate(data, header, dark=dark) # Subtract dark and linearize
-
-            if image.type not in ['flat']:
-                cflat = find_calibration_image(image, 'masterflat')
-                if cflat is not None:
-                    flat = fits.getdata(cflat.filename, -1)
-                    data *= np.median(flat)/flat
-        else:
-            data,header = calibrate.crop_overscans(data, header)
+    fmt = request.GET.get('format', 'jpeg')
+    if fmt not in plots.PLOT_FORMATS:
+        fmt = 'jpeg'
 
     if mode == 'zero':
-        fig = Figure(facecolor='white', dpi=72, figsize=(16,8), tight_layout=True)
+        fig = plots.blank_figure((16,8))
     else:
-        fig = Figure(facecolor='white', dpi=72, figsize=(14,12), tight_layout=True)
+        fig = plots.blank_figure((14,12))
 
     if mode == 'bg':
         # Extract the background
@@ -591,62 +635,19 @@ def image_analysis(request, id=0, mode='fwhm'):
             utils.binned_map(obj['x'][match['oidx']][match['idx']], obj['y'][match['oidx']][match['idx']], match['Y'][match['idx']], bins=8, aspect='equal', ax=ax)
             ax.set_title('filter %s aper %.1f' % (header['FILTER'], obj['aper']))
 
-    canvas = FigureCanvas(fig)
-
-    response = HttpResponse(content_type='image/jpeg')
-    canvas.print_jpg(response)
-
-    return response
-
-
-from stdpipe import cutouts
+    return HttpResponse(plots.render_figure(fig, format=fmt), content_type=plots.PLOT_FORMATS[fmt][1])
 
 
-@cache_page(3600)
 @permission_required('auth.can_view_images', raise_exception=True)
+@cache_view(3600, rounding={'ra': 5, 'dec': 5, 'sr': 5, 'qq': 3})
 def image_cutout(request, id=0, size=0, mode='view'):
     image = Images.objects.get(id=id)
     filename = image.filename
     filename = posixpath.join(settings.BASE_DIR, filename)
 
-    data = fits.getdata(filename, -1)
-    header = fits.getheader(filename, -1)
-
-    # Clean up the header from COMMENT and HISTORY keywords that may break things
-    header.remove('COMMENT', remove_all=True, ignore_missing=True)
-    header.remove('HISTORY', remove_all=True, ignore_missing=True)
-
-    cdark = find_calibration_image(image, 'masterdark')
-    if cdark is not None:
-        dark = fits.getdata(cdark.filename, -1)
-        if cdark is not None:
-            dark = fits.getdata(cdark.filename, -1)
-        else:
-            cbias,cdc = find_calibration_image(image, 'bias'), find_calibration_image(image, 'dcurrent')
-            if cbias is not None and cdc is not None:
-                bias = fits.getdata(cbias.filename, -1)
-                dc = fits.getdata(cdc.filename, -1)
-
-                dark = bias + image.exposure*dc
-            else:
-                dark = None
-
-        if dark is not None:
-            data,header = calibrate.calibrate(data, header, dark=dark) # Subtract dark and linearize
-
-            cflat = find_calibration_image(image, 'masterflat')
-            if cflat is not None:
-                flat = fits.getdata(cflat.filename, -1)
-                data *= np.median(flat)/flat
-
     ra,dec,sr = float(request.GET.get('ra')), float(request.GET.get('dec')), float(request.GET.get('sr'))
 
-    wcs = WCS(header)
-    x0,y0 = wcs.all_world2pix(ra, dec, sr)
-    r0 = sr/np.hypot(wcs.pixel_scale_matrix[0,0], wcs.pixel_scale_matrix[0,1])
-
-    # crop,cropheader = utils.crop_image(data, x0, y0, r0, header)
-    crop,cropheader = cutouts.crop_image_centered(data, x0, y0, r0, header=header)
+    crop,cropheader = stamps.make_cutout(image, ra, dec, sr, region=(mode != 'download'))
 
     if mode == 'download':
         s = BytesIO()
@@ -658,10 +659,7 @@ def image_cutout(request, id=0, size=0, mode='view'):
         return response
 
     if size:
-        if size > crop.shape[1]:
-            crop = rescale(crop, size/crop.shape[1], mode='reflect', anti_aliasing=False, order=0)
-        else:
-            crop = rescale(crop, size/crop.shape[1], mode='reflect', anti_aliasing=True)
+        crop = stamps.resize_cutout(crop, size)
 
     response = image_response(
         crop,
@@ -671,3 +669,105 @@ def image_cutout(request, id=0, size=0, mode='view'):
     )
 
     return response
+
+
+@permission_required('auth.can_view_images', raise_exception=True)
+@cache_view(3600, rounding={'ra': 5, 'dec': 5, 'sr': 5, 'qq': 3})
+def images_cutouts_batch(request, mode='sprite'):
+    """
+    Preview cutouts around the same position for a list of images, as a single column
+    sprite image or as a ZIP of separate JPEGs, in the order of image ids
+    """
+    try:
+        ids = [int(_) for _ in request.GET.get('ids', '').split(',') if _][:settings.CUTOUTS_BATCH_SIZE]
+        ra,dec,sr = float(request.GET.get('ra')), float(request.GET.get('dec')), float(request.GET.get('sr'))
+        size = min(max(int(request.GET.get('size', 300)), 16), 1000)
+    except (ValueError, TypeError):
+        return HttpResponseBadRequest('Malformed ids or position')
+
+    images = Images.objects.in_bulk(ids)
+    images = [images[_] for _ in ids if _ in images]
+
+    if mode != 'zip':
+        # Single column sprite has to fit into maximal JPEG dimensions
+        size = min(size, JPEG_MAX_SIZE // max(1, len(images)))
+
+    qq = [2.5, float(request.GET.get('qq', 99.75))]
+    cmap = request.GET.get('cmap', 'Blues_r')
+    quality = int(request.GET.get('quality', 75))
+
+    def stamp(image, crop, header):
+        return previews.colorize(stamps.resize_cutout(crop, size), qq=qq, cmap=cmap)
+
+    results = stamps.map_cutouts(stamp, images, ra, dec, sr)
+
+    if mode == 'zip':
+        s = BytesIO()
+
+        with zipfile.ZipFile(s, 'w', zipfile.ZIP_STORED) as zf:
+            for image,result in results:
+                if result is not None:
+                    success,buf = cv2.imencode('.jpg', result, [cv2.IMWRITE_JPEG_QUALITY, quality])
+                    if success:
+                        zf.writestr('cutout_%d.jpg' % image.id, buf.tobytes())
+
+        response = HttpResponse(s.getvalue(), content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename=cutouts_%s_%s_%s.zip' % (ra, dec, sr)
+        return response
+
+    sprite = stamps.make_sprite([_[1] for _ in results], size)
+    success,buf = cv2.imencode('.jpg', sprite, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not success:
+        return HttpResponse(status=500)
+
+    return HttpResponse(buf.tobytes(), content_type='image/jpeg')
+
+
+@permission_required('auth.can_view_images', raise_exception=True)
+def images_cutouts_download(request, mode='tar'):
+    """
+    All cutouts matching the cutouts page query, streamed as a tar of FITS files,
+    or as a single multi-extension FITS file with one extension per frame
+    """
+    images,params = get_cutout_images(request)
+    ra,dec,sr = params['ra'], params['dec'], params['sr']
+
+    # Time ordering keeps the frames from the same night together
+    images = images.order_by('-time')[:settings.CUTOUTS_EXPORT_SIZE]
+
+    name = 'cutouts_%s_%s_%s' % (ra, dec, sr)
+
+    if mode == 'fits':
+        def serialize(image, crop, header):
+            return streams.fits_extension(crop, header, name='IMAGE%d' % image.id)
+
+        def stream():
+            header = fits.Header()
+            header['RA'] = (ra, 'Cutouts center RA')
+            header['DEC'] = (dec, 'Cutouts center Dec')
+            header['SR'] = (sr, 'Cutouts radius')
+            yield streams.fits_primary(header)
+
+            for image,result in stamps.map_cutouts(serialize, images.iterator(), ra, dec, sr, region=False):
+                if result is not None:
+                    yield result
+
+        response = StreamingHttpResponse(stream(), content_type='application/fits')
+        response['Content-Disposition'] = 'attachment; filename=%s.fits' % name
+
+    else:
+        def serialize(image, crop, header):
+            return streams.fits_bytes(crop, header)
+
+        def stream():
+            for image,result in stamps.map_cutouts(serialize, images.iterator(), ra, dec, sr, region=False):
+                if result is not None:
+                    filename = 'crop_' + os.path.split(image.filename)[-1]
+                    yield from streams.tar_member(posixpath.join(name, filename), len(result), [result])
+
+            yield streams.tar_end()
+
+        response = StreamingHttpResponse(stream(), content_type='application/x-tar')
+        response['Content-Disposition'] = 'attachment; filename=%s.tar' % name
+
+    return response
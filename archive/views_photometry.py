@@ -1,19 +1,17 @@
-from django.http import HttpResponse, FileResponse
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse
 from django.template.response import TemplateResponse
 from django.shortcuts import redirect
 from django.views.decorators.cache import cache_page
 from django.views.decorators.csrf import csrf_protect
 from django.db.models import Q
 
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-from matplotlib.figure import Figure
 import numpy as np
 import json
-
-from astropy.time import Time
-from astropy.stats import mad_std
+import itertools
 
 from .models import Photometry
+from .plots import PLOT_FORMATS, FILTER_COLORS, plot_lc
+from .lightcurves import cached_lc, format_times, format_lines, format_lc_text, stream_lc_text, encode_json, encode_binary, quality_mask
 
 
 def radectoxieta(ra, dec, ra0=0, dec0=0):
@@ -36,79 +34,103 @@ def radectoxieta(ra, dec, ra0=0, dec0=0):
     return xi,eta
 
 
-def get_lc(request):
+def lc_params(request):
+    """
+    Normalized light curve query parameters, with coordinates rounded so that
+    equivalent requests share the cached results
+    """
+    params = {}
+
+    for name in ['night', 'night1', 'night2', 'site', 'filter', 'ccd']:
+        value = request.GET.get(name)
+        if value and value != 'all':
+            params[name] = value
+
+    magerr = request.GET.get('magerr')
+    if magerr:
+        params['magerr'] = float(magerr)
+
+    nstars = request.GET.get('nstars')
+    if nstars:
+        params['nstars'] = int(nstars)
+
+    params['ra'] = round(float(request.GET.get('ra')), 5)
+    params['dec'] = round(float(request.GET.get('dec')), 5)
+    params['sr'] = round(float(request.GET.get('sr', 0.01)), 5)
+
+    return params
+
+
+def get_lc(params):
     lc = Photometry.objects.order_by('time')
 
-    night = request.GET.get('night')
-    if night and night != 'all':
-        lc = lc.filter(night=night)
+    if params.get('night'):
+        lc = lc.filter(night=params['night'])
 
-    night1 = request.GET.get('night1')
-    if night1:
-        lc = lc.filter(night__gte=night1)
+    if params.get('night1'):
+        lc = lc.filter(night__gte=params['night1'])
 
-    night2 = request.GET.get('night2')
-    if night2:
-        lc = lc.filter(night__lte=night2)
+    if params.get('night2'):
+        lc = lc.filter(night__lte=params['night2'])
 
     # Filter out bad data
     lc = lc.filter(Q(night__lt='20190216') | Q(night__gt='20190222'))
 
-    site = request.GET.get('site')
-    if site and site != 'all':
-        lc = lc.filter(site=site)
+    if params.get('site'):
+        lc = lc.filter(site=params['site'])
 
-    fname = request.GET.get('filter')
-    if fname and fname != 'all':
-        lc = lc.filter(filter=fname)
+    if params.get('filter'):
+        lc = lc.filter(filter=params['filter'])
 
-    ccd = request.GET.get('ccd')
-    if ccd and ccd != 'all':
-        lc = lc.filter(ccd=ccd)
+    if params.get('ccd'):
+        lc = lc.filter(ccd=params['ccd'])
 
-    magerr = request.GET.get('magerr')
-    if magerr:
-        magerr = float(magerr)
-        lc = lc.filter(magerr__lt=magerr)
+    if params.get('magerr'):
+        lc = lc.filter(magerr__lt=params['magerr'])
 
-    nstars = request.GET.get('nstars')
-    if nstars:
-        nstars = int(nstars)
-        lc = lc.filter(nstars__gte=nstars)
-
-    ra = float(request.GET.get('ra'))
-    dec = float(request.GET.get('dec'))
-    sr = float(request.GET.get('sr', 0.01))
+    if params.get('nstars'):
+        lc = lc.filter(nstars__gte=params['nstars'])
 
     # Lc with centers within given search radius
-    lc = lc.extra(where=["q3c_radial_query(ra, dec, %s, %s, %s)"], params=(ra, dec, sr))
+    lc = lc.extra(where=["q3c_radial_query(ra, dec, %s, %s, %s)"], params=(params['ra'], params['dec'], params['sr']))
 
     return lc
 
 
 def lc(request, mode="jpg", size=800):
-    lc = get_lc(request)
-
-    times = np.array([_.time for _ in lc])
-    sites = np.array([_.site for _ in lc])
-    ccds = np.array([_.ccd for _ in lc])
-    filters = np.array([_.filter for _ in lc])
-    ras = np.array([_.ra for _ in lc])
-    decs = np.array([_.dec for _ in lc])
-    mags = np.array([_.mag for _ in lc])
-    magerrs = np.array([_.magerr for _ in lc])
-    flags = np.array([_.flags for _ in lc])
-    fwhms = np.array([_.fwhm for _ in lc])
-    stds = np.array([_.std for _ in lc])
-    nstars = np.array([_.nstars for _ in lc])
-
-    mjds = Time(times).mjd if len(times) else []
-
-    cols = np.array([{'B':'blue', 'V':'green', 'R':'red', 'I':'orange', 'z':'magenta'}.get(_, 'black') for _ in filters])
-
-    ra = float(request.GET.get('ra'))
-    dec = float(request.GET.get('dec'))
-    sr = float(request.GET.get('sr', 0.01))
+    params = lc_params(request)
+    ra,dec,sr = params['ra'], params['dec'], params['sr']
+
+    if mode == 'text':
+        # Full unfiltered light curve, streamed directly from the database if not cached
+        data = cached_lc(params, get_lc(params), fetch=False)
+
+        if data is not None:
+            response = StreamingHttpResponse(format_lc_text([data]), content_type='text/plain')
+        else:
+            response = StreamingHttpResponse(stream_lc_text(get_lc(params)), content_type='text/plain')
+
+        response['Content-Disposition'] = 'attachment; filename=lc_full_%s_%s_%s.txt' % (ra, dec, sr)
+
+        return response
+
+    data = cached_lc(params, get_lc(params))
+
+    times = data['time']
+    sites = data['site']
+    ccds = data['ccd']
+    filters = data['filter']
+    ras = data['ra']
+    decs = data['dec']
+    mags = data['mag']
+    magerrs = data['magerr']
+    flags = data['flags']
+    fwhms = data['fwhm']
+    stds = data['std']
+    nstars = data['nstars']
+
+    mjds = data['mjd']
+
     name = request.GET.get('name')
 
     if name in ['sexadecimal', 'degrees']:
@@ -120,24 +142,10 @@ def lc(request, mode="jpg", size=800):
         filtering = True
 
     # Quality cuts
-    idx0 = np.ones_like(mags, dtype=bool)
     if filtering:
-        mask = np.zeros_like(mags, dtype=bool)
-
-        idx0 &= flags < 2
-
-        for fn in np.unique(filters):
-            idx = idx0 & (filters == fn)
-
-            for _ in range(3):
-                idx &= stds < np.median(stds[idx]) + 3.0*mad_std(stds[idx])
-
-            for _ in range(3):
-                idx &= fwhms < np.median(fwhms[idx]) + 3.0*mad_std(fwhms[idx])
-
-            mask |= idx
-
-        idx0 = mask
+        idx0 = quality_mask(data)
+    else:
+        idx0 = np.ones_like(mags, dtype=bool)
 
     context = {}
 
@@ -159,9 +167,11 @@ def lc(request, mode="jpg", size=800):
 
     if mode == 'jpeg':
         # Plot lc
-        fig = Figure(facecolor='white', dpi=72, figsize=(size/72,0.5*size/72), tight_layout=True)
-        ax = fig.add_subplot(111)
-        ax.grid(True, alpha=0.1, color='gray')
+        fmt = request.GET.get('format', 'jpeg')
+        if fmt not in PLOT_FORMATS:
+            fmt = 'jpeg'
+
+        lcs = []
 
         for fn in np.unique(filters):
             idx = idx0 & (filters == fn)
@@ -169,22 +179,11 @@ def lc(request, mode="jpg", size=800):
             if len(mags[idx]) < 2:
                 continue
 
-            ax.errorbar(times[idx], mags[idx], magerrs[idx], fmt='.', color=cols[idx][0], capsize=0, alpha=0.3)
-            ax.scatter(times[idx], mags[idx], marker='.', c=cols[idx][0])
-            ax.invert_yaxis()
+            lcs.append((FILTER_COLORS.get(fn, 'black'), times[idx], mags[idx], magerrs[idx]))
 
-        ax.invert_yaxis()
+        return HttpResponse(plot_lc(lcs, title=title, size=size, format=fmt), content_type=PLOT_FORMATS[fmt][1])
 
-        ax.set_title(title)
-
-        canvas = FigureCanvas(fig)
-
-        response = HttpResponse(content_type='image/jpeg')
-        canvas.print_jpg(response)
-
-        return response
-
-    elif mode == 'json':
+    elif mode in ['json', 'binary']:
         lcs = []
 
         for fn in np.unique(filters):
@@ -193,50 +192,41 @@ def lc(request, mode="jpg", size=800):
             if len(mags[idx]) < 2:
                 continue
 
-            times_idx = [_.isoformat() for _ in times[idx]]
+            if mode == 'json':
+                times_idx = format_times(times[idx], sep='T')
+            else:
+                # Milliseconds since Unix epoch, as expected by JavaScript
+                times_idx = times[idx].astype(np.int64) / 1000
 
-            lcs.append({'filter': fn, 'color': cols[idx][0],
-                        'times': times_idx, 'mjds': list(mjds[idx]), 'xi': list(xi[idx]), 'eta': list(eta[idx]),
-                        'mags': list(mags[idx]), 'magerrs': list(magerrs[idx]), 'flags': list(flags[idx]),
-                        'fwhms': list(fwhms[idx]), 'stds': list(stds[idx]), 'nstars': list(nstars[idx])})
+            lcs.append({'filter': fn, 'color': FILTER_COLORS.get(fn, 'black'),
+                        'times': times_idx, 'mjds': mjds[idx], 'xi': xi[idx], 'eta': eta[idx],
+                        'mags': mags[idx], 'magerrs': magerrs[idx], 'flags': flags[idx],
+                        'fwhms': fwhms[idx], 'stds': stds[idx], 'nstars': nstars[idx]})
 
         data = {'name': name, 'title': title, 'ra': ra, 'dec': dec, 'sr': sr, 'lcs': lcs}
 
-        return HttpResponse(json.dumps(data, default=str), content_type="application/json")
-
-    elif mode == 'text':
-        response = HttpResponse(request, content_type='text/plain')
-
-        response['Content-Disposition'] = 'attachment; filename=lc_full_%s_%s_%s.txt' % (ra, dec, sr)
-
-        print('# Date Time MJD Site CCD Filter Mag Magerr Flags FWHM Std Nstars', file=response)
-
-        for _ in range(len(times)):
-            print(times[_], mjds[_], sites[_], ccds[_], filters[_], mags[_], magerrs[_], flags[_], fwhms[_], stds[_], nstars[_], file=response)
-
-        return response
+        if mode == 'json':
+            return HttpResponse(encode_json(data), content_type="application/json")
+        else:
+            return HttpResponse(encode_binary(data), content_type="application/octet-stream")
 
     elif mode == 'mjd':
-        response = HttpResponse(request, content_type='text/plain')
-
-        response['Content-Disposition'] = 'attachment; filename=lc_mjd_%s_%s_%s.txt' % (ra, dec, sr)
-
         if len(np.unique(filters)) == 1:
             single = True
         else:
             single = False
 
+        idx = idx0
+
         if single:
-            print('# MJD Mag Magerr', file=response)
+            header = '# MJD Mag Magerr\n'
+            columns = [mjds[idx], mags[idx], magerrs[idx]]
         else:
-            print('# MJD Mag Magerr Filter', file=response)
+            header = '# MJD Mag Magerr Filter\n'
+            columns = [mjds[idx], mags[idx], magerrs[idx], filters[idx]]
 
-        idx = idx0
+        response = StreamingHttpResponse(itertools.chain([header], format_lines(columns)), content_type='text/plain')
 
-        for _ in range(len(times[idx])):
-            if single:
-                print(mjds[idx][_], mags[idx][_], magerrs[idx][_], file=response)
-            else:
-                print(mjds[idx][_], mags[idx][_], magerrs[idx][_], filters[idx][_], file=response)
+        response['Content-Disposition'] = 'attachment; filename=lc_mjd_%s_%s_%s.txt' % (ra, dec, sr)
 
         return response